@@ -0,0 +1,83 @@
+"""Round trip of Attack.save / Attack.load through the shard store, against the single-file format.
+
+    python -m benchmarks.bench_attack_store --num_images 512 --batch_size 64
+"""
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from evals.attack import Attack
+from evals.fgsm import FGSM
+
+
+def load_all(loader):
+    return [torch.cat(items) for items in zip(*loader)]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--num_images', default=512, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--image_size', default=32, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(3 * args.image_size ** 2, 10))
+    inputs = torch.rand(args.num_images, 3, args.image_size, args.image_size)
+    labels = torch.randint(10, (args.num_images,))
+    loader = DataLoader(TensorDataset(inputs, labels), batch_size=args.batch_size)
+    attack = FGSM(model, eps=8 / 255)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for save_type in ['float', 'half', 'int']:
+            save_dir = os.path.join(tmp_dir, f'store_{save_type}')
+            start = time.time()
+            attack.save(loader, save_path=save_dir, verbose=False, save_clean_inputs=True, save_type=save_type)
+            save_time = time.time() - start
+
+            # a second, shorter run into the same directory must replace the store, not extend it
+            short_loader = DataLoader(TensorDataset(inputs[:args.batch_size], labels[:args.batch_size]),
+                                      batch_size=args.batch_size)
+            attack.save(short_loader, save_path=save_dir + '_short', verbose=False, save_type=save_type)
+            attack.save(loader, save_path=save_dir + '_short', verbose=False, save_type=save_type)
+            attack.save(short_loader, save_path=save_dir + '_short', verbose=False, save_type=save_type)
+            assert len(Attack.load(save_dir + '_short').dataset) == args.batch_size
+            assert len(os.listdir(save_dir + '_short')) == 3  # index.json, adv_inputs_00000.bin, labels_00000.bin
+
+            start = time.time()
+            adv_inputs, adv_labels, clean_inputs = load_all(Attack.load(save_dir, batch_size=args.batch_size,
+                                                                        load_clean_inputs=True))
+            load_time = time.time() - start
+
+            # the single-file format of earlier versions holds the same tensors
+            expected = attack(inputs)
+            if save_type == 'int':
+                expected, expected_clean = (expected * 255).type(torch.uint8).float() / 255, \
+                    (inputs * 255).type(torch.uint8).float() / 255
+            elif save_type == 'half':
+                expected, expected_clean = expected.half().float(), inputs.half().float()
+            else:
+                expected_clean = inputs
+            legacy_path = os.path.join(tmp_dir, f'legacy_{save_type}.pt')
+            torch.save({'adv_inputs': expected, 'labels': labels, 'save_type': 'float'}, legacy_path)
+            legacy_inputs, legacy_labels = load_all(Attack.load(legacy_path, batch_size=args.batch_size))
+
+            assert torch.equal(adv_labels, labels) and torch.equal(legacy_labels, labels)
+            max_diff = max((adv_inputs - legacy_inputs).abs().max().item(),
+                           (clean_inputs - expected_clean).abs().max().item())
+            print(f'{save_type:5s} {args.num_images} images: save {save_time * 1e3:.1f}ms  '
+                  f'load {load_time * 1e3:.1f}ms  max |diff| vs single file {max_diff:.2e}')
+
+        try:
+            attack.save(loader, save_path=legacy_path, verbose=False)
+        except ValueError as e:
+            print(f'file save_path rejected: {e}')
+
+
+if __name__ == '__main__':
+    main()
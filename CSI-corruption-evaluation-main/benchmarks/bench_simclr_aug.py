@@ -0,0 +1,68 @@
+"""Throughput of FusedSimCLRAugmentation against the nn.Sequential of get_simclr_augmentation.
+
+    python -m benchmarks.bench_simclr_aug --batch_size 128 --repeat 20 --resize_factor 0.54 --resize_fix
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import models.transform_layers as TL
+
+
+def get_layers(resize_scale, image_size):
+    color_jitter = TL.ColorJitterLayer(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1, p=0.8)
+    color_gray = TL.RandomColorGrayLayer(p=0.2)
+    resize_crop = TL.RandomResizedCropLayer(scale=resize_scale, size=image_size)
+    return color_jitter, color_gray, resize_crop
+
+
+def seeded(fn, x, seed=0):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    return fn(x)
+
+
+def timeit(fn, x, repeat):
+    fn(x)  # warm up
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--resize_factor', default=0.08, type=float)
+    parser.add_argument('--resize_fix', action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    resize_scale = (args.resize_factor, args.resize_factor) if args.resize_fix else (args.resize_factor, 1.0)
+
+    for size in [32, 224]:
+        image_size = (size, size, 3)
+        sequential = nn.Sequential(*get_layers(resize_scale, image_size)).to(device)
+        fused = TL.FusedSimCLRAugmentation(*get_layers(resize_scale, image_size)).to(device)
+        x = torch.rand(args.batch_size, 3, size, size, device=device)
+
+        # same seeds draw the same augmentation parameters in both pipelines
+        max_diff = (seeded(sequential, x) - seeded(fused, x)).abs().max().item()
+
+        old_time = timeit(sequential, x, args.repeat)
+        new_time = timeit(fused, x, args.repeat)
+        print(f'{size}px x {args.batch_size} on {device}: sequential {args.batch_size / old_time:.0f} img/s  '
+              f'fused {args.batch_size / new_time:.0f} img/s  speedup {old_time / new_time:.2f}x  '
+              f'max |diff| {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,9 @@ def parse_args(default=False):
 
     parser.add_argument('--dataset', help='Dataset', default="cifar10", type=str)
     parser.add_argument('--brain_prepared', help='brain prep', default=0, type=int)
+    parser.add_argument('--brain_split_seed', help='seed of the Br35H / BraTS train-test split', default=0, type=int)
+    parser.add_argument('--brain_link_mode', help='how brain prep places files in the split directories',
+                        choices=['copy', 'hardlink', 'symlink'], default='copy', type=str)
     parser.add_argument('--desired_attack', help='desired_attack',
                         choices=['PGD', 'FGSM'],
                         default="PGD", type=str)
@@ -32,6 +35,20 @@ def parse_args(default=False):
                         default=None, type=int)
     parser.add_argument('--cifar_corruption_data', help='',
                         default="./CIFAR-10-C/defocus_blur.npy", type=str)
+    parser.add_argument('--cifar_corruption_severity', help='severities (1-5) of the corruption test set',
+                        default=[5], nargs='+', type=int)
+    parser.add_argument('--cifar_corruption_types', help='corruption files next to cifar_corruption_data '
+                                                         '(all: every corruption, default: that file only)',
+                        default=None, nargs='+', type=str)
+    parser.add_argument('--corruption', help='corruption applied on the fly to the in-distribution test batches',
+                        choices=['gaussian_noise', 'shot_noise', 'impulse_noise', 'speckle_noise', 'gaussian_blur',
+                                 'defocus_blur', 'zoom_blur', 'contrast', 'brightness', 'saturate', 'pixelate',
+                                 'jpeg_compression'],
+                        default=None, type=str)
+    parser.add_argument('--corruption_severity', help='severity (1-5) of --corruption',
+                        default=5, type=int)
+    parser.add_argument('--corrupt_ood', help='apply --corruption to the OOD test sets as well',
+                        action='store_true')
     parser.add_argument('--model', help='Model',
                         choices=['resnet18', 'resnet18_imagenet'], default="resnet18", type=str)
     parser.add_argument('--mode', help='Training mode',
@@ -97,12 +114,50 @@ def parse_args(default=False):
                         default=1, type=int)
     parser.add_argument("--ood_batch_size", help='batch size to compute OOD score',
                         default=100, type=int)
+    parser.add_argument("--feature_chunk_size", help='images per fused forward pass (0: fit the memory budget)',
+                        default=0, type=int)
+    parser.add_argument("--feature_memory_fraction", help='fraction of free memory used by a fused forward pass',
+                        default=0.5, type=float)
+    parser.add_argument("--loader_prefetch", help='batches queued ahead by the interleaved ID/OOD loader stream',
+                        default=8, type=int)
+    parser.add_argument("--loader_max_active", help='loaders (and their workers) read at once by that stream',
+                        default=2, type=int)
+    parser.add_argument("--feature_cache_dir", help='directory of the on-disk feature cache (None: no cache)',
+                        default=None, type=str)
+    parser.add_argument("--score_chunk_size", help='tile size of the (test x train) similarity matrix',
+                        default=4096, type=int)
+    parser.add_argument("--axis_index_type", help='search backend for the max similarity over the train axis',
+                        choices=['exact', 'ivf', 'pq'], default='exact', type=str)
+    parser.add_argument("--ivf_lists", help='number of k-means lists of the ivf index',
+                        default=64, type=int)
+    parser.add_argument("--ivf_probe", help='number of lists visited per query by the ivf index',
+                        default=8, type=int)
+    parser.add_argument("--pq_subspaces", help='number of sub-quantizers of the pq index',
+                        default=16, type=int)
+    parser.add_argument("--pq_rerank", help='number of pq candidates re-scored exactly',
+                        default=32, type=int)
+    parser.add_argument("--axis_index_report", help='report recall, speedup and AUROC change against exact search',
+                        action='store_true')
     parser.add_argument("--test_id", help='batch size to compute OOD score',
                         default=1, type=int)
     parser.add_argument("--resize_factor", help='resize scale is sampled from [resize_factor, 1.0]',
                         default=0.08, type=float)
     parser.add_argument("--resize_fix", help='resize scale is fixed to resize_factor (not (resize_factor, 1.0])',
                         action='store_true')
+    parser.add_argument("--batched_crops", help='take the ImageNet eval views with tensor ops (allows batch_size > 1)',
+                        action='store_true')
+    parser.add_argument("--fused_augmentation", help='run the SimCLR augmentation as one fused module',
+                        action='store_true')
+    parser.add_argument("--shard_cache_dir", help='cache dir of uint8 image shards and split indices (isic/gta/waterbirds/brain/wbc)',
+                        default=None, type=str)
+    parser.add_argument("--one_class_single_pass", help='one-class: score the full test set once, split by label',
+                        action='store_true')
+
+    parser.add_argument("--one_class_checkpoints", help='one_class_sweep.py: checkpoint dir (class index = last '
+                                                         'number in the file name) or json manifest {class: path}',
+                        default=None, type=str)
+    parser.add_argument("--one_class_workers", help='one_class_sweep.py: checkpoints evaluated in parallel processes',
+                        default=1, type=int)
 
     parser.add_argument("--print_score", help='print quantiles of ood score',
                         action='store_true')
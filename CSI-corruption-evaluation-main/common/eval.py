@@ -1,4 +1,4 @@
-from copy import deepcopy
+import time
 
 import torch
 import torch.nn as nn
@@ -6,25 +6,14 @@ from torch.utils.data import DataLoader
 
 from common.common import parse_args
 import models.classifier as C
-from datasets import get_dataset, get_superclass_list, get_subclass_dataset
+from models.corruption_layers import get_corruption_layer, CorruptedLoader
+from datasets import get_dataset, get_superclass_list, get_subclass_dataset, get_loader_unique_label
+from datasets.datasets import get_dataset_labels
 
 P = parse_args()
 
 
 ### Set torch device ###
-
-
-def get_loader_unique_label(loader):
-    print('here is get_loader_unique_label')
-    try:
-        unique_labels = set()
-        for _, labels in loader:
-            unique_labels.update(labels.tolist())
-        unique_labels = sorted(list(unique_labels))
-    except:
-        print("can not compute unique loader!")
-        unique_labels = []
-    return unique_labels
 P.n_gpus = torch.cuda.device_count()
 assert P.n_gpus <= 1  # no multi GPU
 P.multi_gpu = False
@@ -34,8 +23,12 @@ if torch.cuda.is_available():
 device = torch.device(f"cuda" if torch.cuda.is_available() else "cpu")
 
 ### Initialize dataset ###
+startup = time.time()
 ood_eval = P.mode == 'ood_pre'
-if P.dataset == 'imagenet' and ood_eval:
+if P.dataset == 'imagenet' and ood_eval and P.corruption is not None:
+    raise ValueError('--corruption needs batches of single image tensors; the ImageNet eval transforms '
+                     'yield (views, clean) batches')
+if P.dataset == 'imagenet' and ood_eval and not P.batched_crops:  # one image (S views) per batch
     P.batch_size = 1
     P.test_batch_size = 1
 train_set, test_set, image_size, n_classes = get_dataset(P, dataset=P.dataset, eval=ood_eval)
@@ -48,7 +41,7 @@ if P.one_class_idx is not None:
     # del cls_list[P.one_class_idx]
     P.n_superclasses = len(cls_list)
 
-    full_test_set = deepcopy(test_set)  # test set of full classes
+    full_test_set = test_set  # test set of full classes (get_subclass_dataset wraps, never modifies it)
     # train_set = get_subclass_dataset(train_set, classes=cls_list)
     # test_set = get_subclass_dataset(test_set, classes=cls_list)
     
@@ -78,7 +71,13 @@ if P.ood_dataset is None:
 
 # P.ood_dataset = [P.one_class_idx]
 ood_test_loader = dict()
-for ood in P.ood_dataset:
+single_pass = P.one_class_idx is not None and P.one_class_single_pass
+if single_pass:  # every class is masked out of one pass over the full test set
+    assert P.mode == 'ood_pre'
+    full_test_labels = get_dataset_labels(full_test_set)
+    assert full_test_labels is not None, 'single pass one-class evaluation needs a label array'
+    full_test_loader = DataLoader(full_test_set, shuffle=False, batch_size=P.test_batch_size, **kwargs)
+for ood in ([] if single_pass else P.ood_dataset):
     if ood == 'interp':
         ood_test_loader[ood] = None  # dummy loader
         continue
@@ -93,6 +92,20 @@ for ood in P.ood_dataset:
     print("OOD dataset name: ", ood)
     ood_test_loader[ood] = DataLoader(ood_test_set, shuffle=False, batch_size=P.test_batch_size, **kwargs)
     print("Unique labels(ood_test_loader):", get_loader_unique_label(ood_test_loader[ood]))
+print(f'Data startup time: {time.time() - startup:.2f}s')
+
+if P.corruption is not None:  # corrupt the test batches on the device instead of reading corrupted files
+    corruption = get_corruption_layer(P.corruption, P.corruption_severity)
+    print(f"Test corruption: {P.corruption} (severity {P.corruption_severity})")
+    test_loader = CorruptedLoader(test_loader, corruption, device)
+    if single_pass:  # the full test set holds the OOD classes too
+        id_classes = None if P.corrupt_ood else cls_list[P.one_class_idx]
+        full_test_loader = CorruptedLoader(full_test_loader, corruption, device, classes=id_classes)
+    if P.corrupt_ood:  # by default only the in-distribution test set is corrupted
+        print("Corrupt the OOD test sets as well")
+        for ood in ood_test_loader.keys():
+            if ood_test_loader[ood] is not None:
+                ood_test_loader[ood] = CorruptedLoader(ood_test_loader[ood], corruption, device)
 ### Initialize model ###
 
 simclr_aug = C.get_simclr_augmentation(P, image_size=P.image_size).to(device)
@@ -1,3 +1,4 @@
+import time
 from copy import deepcopy
 
 import torch
@@ -8,22 +9,11 @@ from torch.utils.data import DataLoader
 
 from common.common import parse_args
 import models.classifier as C
-from datasets import get_dataset, get_superclass_list, get_subclass_dataset
+from datasets import get_dataset, get_superclass_list, get_subclass_dataset, get_loader_unique_label
 from utils.utils import load_checkpoint
 
 P = parse_args()
 
-def get_loader_unique_label(loader):
-    print('here is get_loader_unique_label')
-    try:
-        unique_labels = set()
-        for _, labels in loader:
-            unique_labels.update(labels.tolist())
-        unique_labels = sorted(list(unique_labels))
-    except:
-        print("can not compute unique loader!")
-        unique_labels = []
-    return unique_labels
 ### Set torch device ###
 
 if torch.cuda.is_available():
@@ -51,9 +41,10 @@ else:
 P.ood_layer = P.ood_layer[0]
 
 ### Initialize dataset ###
+startup = time.time()
 ### Initialize dataset ###
 ood_eval = P.mode == 'ood_pre'
-if P.dataset == 'imagenet' and ood_eval:
+if P.dataset == 'imagenet' and ood_eval and not P.batched_crops:  # one image (S views) per batch
     P.batch_size = 1
     P.test_batch_size = 1
     
@@ -120,6 +111,7 @@ for ood in P.ood_dataset:
     print("OOD dataset name: ", ood)
     ood_test_loader[ood] = DataLoader(ood_test_set, shuffle=False, batch_size=P.test_batch_size, **kwargs)
     print("Unique labels(ood_test_loader):", get_loader_unique_label(ood_test_loader[ood]))
+print(f'Data startup time: {time.time() - startup:.2f}s')
 
 ### Initialize model ###
 
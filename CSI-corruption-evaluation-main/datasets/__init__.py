@@ -1,2 +1,2 @@
-from datasets.datasets import get_dataset, get_superclass_list, get_subclass_dataset
+from datasets.datasets import get_dataset, get_superclass_list, get_subclass_dataset, get_loader_unique_label
 
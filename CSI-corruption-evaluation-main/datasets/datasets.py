@@ -6,9 +6,12 @@ from pathlib import Path
 
 import numpy as np
 import torch
-from torch.utils.data.dataset import Subset
+import torch.nn.functional as F
+from torch.utils.data.dataset import ConcatDataset, Subset, TensorDataset
 from torchvision import datasets, transforms
 
+import models.transform_layers as TL
+from datasets.shard_cache import ShardCachedDataset, cached_index, get_dataframe_digest
 from utils.utils import set_random_seed
 
 DATA_PATH = './data/'
@@ -67,27 +70,75 @@ def sparse2coarse(targets):
     return coarse_labels[targets]
 
 
+CIFAR_CORRUPTIONS = ['brightness', 'contrast', 'defocus_blur', 'elastic_transform', 'fog', 'frost',
+                     'gaussian_blur', 'gaussian_noise', 'glass_blur', 'impulse_noise', 'jpeg_compression',
+                     'motion_blur', 'pixelate', 'saturate', 'shot_noise', 'snow', 'spatter', 'speckle_noise',
+                     'zoom_blur']
+CIFAR_CORRUPTION_SIZE = 10000  # images per severity in each CIFAR-10-C / CIFAR-100-C file
+
+# datasets that decode image files on every access; --shard_cache_dir serves them from uint8 shards
+SHARD_CACHE_DATASETS = ['isic', 'gta', 'waterbirds', 'brain', 'wbc']
+
+
 class CIFAR_CORRUCPION(Dataset):
+    """CIFAR-10-C / CIFAR-100-C test images of the given severities and corruption types.
+
+    The .npy files are memory-mapped and samples are served as (3, 32, 32) float tensors in [0, 1]
+    (the models normalize internally). `corruption_types` are looked up next to
+    `cifar_corruption_data`; when None, only `cifar_corruption_data` itself is used.
+    """
+
     def __init__(self, transform=None, normal_idx=[0], cifar_corruption_label='CIFAR-10-C/labels.npy',
-                 cifar_corruption_data='./CIFAR-10-C/defocus_blur.npy'):
-        self.labels_10 = np.load(cifar_corruption_label)
-        self.labels_10 = self.labels_10[40000:50000]
+                 cifar_corruption_data='./CIFAR-10-C/defocus_blur.npy', severity=5, corruption_types=None):
+        self.severity = [severity] if isinstance(severity, int) else sorted(severity)
+        assert all(1 <= s <= 5 for s in self.severity)
+        self.rows = np.concatenate([np.arange((s - 1) * CIFAR_CORRUPTION_SIZE, s * CIFAR_CORRUPTION_SIZE)
+                                    for s in self.severity])
+
+        if corruption_types == ['all']:
+            corruption_types = CIFAR_CORRUPTIONS
+        if corruption_types is None:
+            self.data_paths = [cifar_corruption_data]
+        else:
+            data_dir = os.path.dirname(cifar_corruption_data)
+            self.data_paths = [os.path.join(data_dir, f'{name}.npy') for name in corruption_types]
+        self.data_path = ';'.join(self.data_paths)
+        self.data = [np.load(path, mmap_mode='r') for path in self.data_paths]
+
+        labels = np.load(cifar_corruption_label, mmap_mode='r')[self.rows]
         if cifar_corruption_label == 'CIFAR-100-C/labels.npy':
-            self.labels_10 = sparse2coarse(self.labels_10)
-        self.data = np.load(cifar_corruption_data)
-        self.data = self.data[40000:50000]
+            labels = sparse2coarse(labels)
+        self.labels_10 = np.tile(labels, len(self.data))  # labels are shared by every corruption file
         self.transform = transform
 
+    def _load(self, indices):
+        """Read (n, 32, 32, 3) uint8 images of flat `indices` with one fancy-index per file."""
+        indices = np.asarray(indices)
+        file_idx, row_idx = np.divmod(indices, len(self.rows))
+        x = np.empty((len(indices),) + self.data[0].shape[1:], dtype=np.uint8)
+        for f in np.unique(file_idx):
+            mask = file_idx == f
+            rows = self.rows[row_idx[mask]]
+            order = np.argsort(rows)  # sorted reads keep the memmap access sequential
+            x[np.flatnonzero(mask)[order]] = self.data[f][rows[order]]
+        return torch.from_numpy(x).permute(0, 3, 1, 2).float().div(255)
+
     def __getitem__(self, index):
-        x = self.data[index]
+        x = self._load([index])[0]
         y = self.labels_10[index]
         if self.transform:
-            x = Image.fromarray(x.astype(np.uint8))
             x = self.transform(x)
         return x, y
 
+    def __getitems__(self, indices):
+        # batched path of the DataLoader: one read per file instead of one per image
+        x = self._load(indices)
+        if self.transform:
+            x = [self.transform(x_i) for x_i in x]
+        return [(x_i, self.labels_10[i]) for x_i, i in zip(x, indices)]
+
     def __len__(self):
-        return len(self.data)
+        return len(self.labels_10)
 
 
 class MultiDataTransform(object):
@@ -108,15 +159,70 @@ class MultiDataTransformList(object):
         self.sample_num = sample_num
 
     def __call__(self, sample):
-        set_random_seed(0)
-
-        sample_list = []
-        for i in range(self.sample_num):
-            sample_list.append(self.transform(sample))
+        # every sample gets the same views; the torchvision transforms draw from the torch
+        # RNG, so run them on a forked copy seeded with 0 instead of reseeding the global RNGs
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(0)
+            sample_list = []
+            for i in range(self.sample_num):
+                sample_list.append(self.transform(sample))
 
         return sample_list, self.clean_transform(sample)
 
 
+class MultiCropTransform(object):
+    """Batched counterpart of MultiDataTransformList(RandomResizedCrop + flip).
+
+    The image is decoded, resized and converted to a tensor once; the `sample_num`
+    crops are then taken from it with grid_sample. A crop larger than `size` is taken
+    from an antialiased downscale of the image (as PIL does when resizing), so the views
+    are not aliased. Every image gets the same crop/flip draws (generator seeded with 0),
+    as in MultiDataTransformList.
+    Returns ((sample_num, C, size, size) views, (C, size, size) center crop).
+    """
+
+    def __init__(self, sample_num, size=224, resize=256, scale=(0.08, 1.0)):
+        self.sample_num = sample_num
+        self.size = size
+        self.resize = transforms.Compose([
+            transforms.Resize(resize),
+            transforms.ToTensor(),
+        ])
+        self.resize_crop = TL.RandomResizedCropLayer(scale=scale)
+
+    def __call__(self, sample):
+        x = self.resize(sample)  # (C, H, W)
+        C, H, W = x.shape
+        S = self.sample_num
+        generator = torch.Generator().manual_seed(0)
+
+        x_rep = x.unsqueeze(0).expand(S, C, H, W)
+        whbias = self.resize_crop._sample_latent(x_rep, generator=generator)  # (S, 4)
+        flip = torch.bernoulli(torch.full((S,), 0.5), generator=generator) * 2 - 1
+
+        _theta = torch.zeros(S, 2, 3, dtype=x.dtype)
+        _theta[:, 0, 0] = whbias[:, 0] * flip
+        _theta[:, 1, 1] = whbias[:, 1]
+        _theta[:, 0, 2] = whbias[:, 2]
+        _theta[:, 1, 2] = whbias[:, 3]
+        grid = F.affine_grid(_theta, (S, C, self.size, self.size), align_corners=False)
+        views = []
+        for i in range(S):
+            # downscale so the crop spans about `size` pixels; normalized coordinates are unchanged
+            out_h = min(int(round(self.size / whbias[i, 1].item())), H)
+            out_w = min(int(round(self.size / whbias[i, 0].item())), W)
+            x_i = x.unsqueeze(0)
+            if (out_h, out_w) != (H, W):
+                x_i = F.interpolate(x_i, size=(out_h, out_w), mode='bilinear', align_corners=False, antialias=True)
+            views.append(F.grid_sample(x_i, grid[i:i + 1], padding_mode='reflection', align_corners=False))
+        views = torch.cat(views)
+
+        top = int(round((H - self.size) / 2.))
+        left = int(round((W - self.size) / 2.))
+        clean = x[:, top:top + self.size, left:left + self.size]
+        return views, clean
+
+
 def get_transform(image_size=None):
     # Note: data augmentation is implemented in the layers
     # Hence, we only define the identity transformation here
@@ -139,15 +245,17 @@ def get_transform(image_size=None):
     return train_transform, test_transform
 
 
-def get_subset_with_len(dataset, length, shuffle=False):
+def get_subset_indices(dataset_size, length, shuffle=False):
+    """Indices kept by get_subset_with_len (same seed and random draws)."""
     set_random_seed(0)
-    dataset_size = len(dataset)
-
     index = np.arange(dataset_size)
     if shuffle:
         np.random.shuffle(index)
+    return index[0:length]
 
-    index = torch.from_numpy(index[0:length])
+
+def get_subset_with_len(dataset, length, shuffle=False):
+    index = torch.from_numpy(get_subset_indices(len(dataset), length, shuffle=shuffle))
     subset = Subset(dataset, index)
 
     assert len(subset) == length
@@ -173,47 +281,90 @@ def get_transform_imagenet():
     return train_transform, test_transform
 
 
-class MNIST_Dataset(Dataset):
+DIAGVIB_PATH = {
+    'mn': '/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset',
+    'fmnist': '/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset',
+}
+DIAGVIB_NPY_PATH = os.path.join(DATA_PATH, 'diagvib')  # output of datasets/diagvib_preprocess.py
+# split -> (normal pickle, abnormal pickle)
+DIAGVIB_SPLITS = {
+    'train': ('train_normal', None),
+    'test_main': ('test_normal_main', 'test_abnormal_main'),
+    'test_shifted': ('test_normal_shifted', 'test_abnormal_shifted'),
+}
+
+
+def check_diagvib_images(images, source):
+    """Raise if images is not the (N, H, W, C) uint8 array (C = 1 or 3) the transforms expect."""
+    if images.dtype != np.uint8 or images.ndim != 4 or images.shape[-1] not in (1, 3):
+        raise ValueError(f'{source}: expected (N, H, W, 1 or 3) uint8 images, '
+                         f'got {images.shape} {images.dtype}')
+
+
+def to_uint8_hwc(images, source):
+    """Stacked DiagViB images as (N, H, W, C) uint8: (N, H, W) gets a channel axis, (N, C, H, W)
+    is transposed and [0, 1] floats are scaled; any other layout raises a ValueError."""
+    if images.ndim == 3:
+        images = images[..., None]
+    if images.ndim == 4 and images.shape[1] in (1, 3) and images.shape[-1] not in (1, 3):
+        images = images.transpose(0, 2, 3, 1)
+    if np.issubdtype(images.dtype, np.floating) and images.size > 0 and 0 <= images.min() and images.max() <= 1:
+        images = np.round(images * 255)
+    if images.dtype != np.uint8 and images.size > 0 and 0 <= images.min() and images.max() <= 255 \
+            and np.array_equal(images, np.round(images)):
+        images = images.astype(np.uint8)
+    check_diagvib_images(images, source)
+    return np.ascontiguousarray(images)
+
+
+def load_diagvib_pickles(root, split):
+    """Unpickle one DiagViB split into a stacked (N, H, W, C) uint8 image array and a
+    0 (normal) / 1 (abnormal) label array."""
+    images, labels = [], []
+    for label, name in enumerate(DIAGVIB_SPLITS[split]):
+        if name is None:
+            continue
+        path = os.path.join(root, f'{name}.pkl')
+        with open(path, 'rb') as f:
+            split_images = pickle.load(f)['images']
+        images.append(to_uint8_hwc(np.stack([np.asarray(image) for image in split_images]), path))
+        labels.append(np.full(len(split_images), label, dtype=np.int64))
+    return np.concatenate(images), np.concatenate(labels)
+
+
+class DiagVibDataset(Dataset):
+    """One split of a DiagViB-6 dataset.
+
+    Reads the .npy files of datasets/diagvib_preprocess.py as copy-on-write memory maps
+    when they exist and otherwise unpickles only the requested split. Images are stored
+    as (N, H, W, C) uint8 and handed to the transform as arrays (ToPILImage reads them
+    as HWC); without a transform, samples are (C, H, W) uint8 tensors.
+    """
+    name = None
+
     def __init__(self, train, test_id=1, transform=None):
         self.transform = transform
         self.train = train
         self.test_id = test_id
-        if train:
-            with open('/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset/train_normal.pkl',
-                      'rb') as f:
-                normal_train = pickle.load(f)
-            self.images = normal_train['images']
-            self.labels = [0] * len(self.images)
+        split = 'train' if train else ('test_main' if test_id == 1 else 'test_shifted')
+
+        npy_dir = os.path.join(DIAGVIB_NPY_PATH, self.name)
+        if os.path.exists(os.path.join(npy_dir, f'{split}_labels.npy')):
+            self.images = np.load(os.path.join(npy_dir, f'{split}_images.npy'), mmap_mode='c')
+            self.labels = np.load(os.path.join(npy_dir, f'{split}_labels.npy'))
+            # written by an older diagvib_preprocess: rerun it
+            check_diagvib_images(self.images, os.path.join(npy_dir, f'{split}_images.npy'))
         else:
-            if test_id == 1:
-                with open('/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset/test_normal_main.pkl',
-                          'rb') as f:
-                    normal_test = pickle.load(f)
-                with open('/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset/test_abnormal_main.pkl',
-                          'rb') as f:
-                    abnormal_test = pickle.load(f)
-                self.images = normal_test['images'] + abnormal_test['images']
-                self.labels = [0] * len(normal_test['images']) + [1] * len(abnormal_test['images'])
-            else:
-                with open('/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset/test_normal_shifted.pkl',
-                          'rb') as f:
-                    normal_test = pickle.load(f)
-                with open(
-                        '/kaggle/input/diagvib-6-mnist-dataset/content/mnist_shifted_dataset/test_abnormal_shifted.pkl',
-                        'rb') as f:
-                    abnormal_test = pickle.load(f)
-                self.images = normal_test['images'] + abnormal_test['images']
-                self.labels = [0] * len(normal_test['images']) + [1] * len(abnormal_test['images'])
+            self.images, self.labels = load_diagvib_pickles(DIAGVIB_PATH[self.name], split)
 
     def __getitem__(self, index):
-        image = torch.tensor(self.images[index])
+        image = self.images[index]  # (H, W, C) uint8 view, no copy
 
         if self.transform is not None:
-            image = self.transform(image)
-
-        height = image.shape[1]
-        width = image.shape[2]
-        target = 0 if self.train else self.labels[index]
+            image = self.transform(image)  # ToPILImage reads the array as HWC
+        else:
+            image = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        target = 0 if self.train else self.labels[index].item()
 
         return image, target
 
@@ -221,51 +372,12 @@ class MNIST_Dataset(Dataset):
         return len(self.images)
 
 
-class FMNIST_Dataset(Dataset):
-    def __init__(self, train, test_id=1, transform=None):
-        self.transform = transform
-        self.train = train
-        self.test_id = test_id
-        if train:
-            with open('/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset/train_normal.pkl',
-                      'rb') as f:
-                normal_train = pickle.load(f)
-            self.images = normal_train['images']
-            self.labels = [0] * len(self.images)
-        else:
-            if test_id == 1:
-                with open('/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset/test_normal_main.pkl',
-                          'rb') as f:
-                    normal_test = pickle.load(f)
-                with open(
-                        '/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset/test_abnormal_main.pkl',
-                        'rb') as f:
-                    abnormal_test = pickle.load(f)
-                self.images = normal_test['images'] + abnormal_test['images']
-                self.labels = [0] * len(normal_test['images']) + [1] * len(abnormal_test['images'])
-            else:
-                with open(
-                        '/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset/test_normal_shifted.pkl',
-                        'rb') as f:
-                    normal_test = pickle.load(f)
-                with open(
-                        '/kaggle/input/diagvib-6-fmnist-dataset/content/fmnist_shifted_dataset/test_abnormal_shifted.pkl',
-                        'rb') as f:
-                    abnormal_test = pickle.load(f)
-                self.images = normal_test['images'] + abnormal_test['images']
-                self.labels = [0] * len(normal_test['images']) + [1] * len(abnormal_test['images'])
+class MNIST_Dataset(DiagVibDataset):
+    name = 'mn'
 
-    def __getitem__(self, index):
-        image = torch.tensor(self.images[index])
 
-        if self.transform is not None:
-            image = self.transform(image)
-        target = 0 if self.train else self.labels[index]
-
-        return image, target
-
-    def __len__(self):
-        return len(self.images)
+class FMNIST_Dataset(DiagVibDataset):
+    name = 'fmnist'
 
 
 import random
@@ -322,6 +434,9 @@ class GTA(Dataset):
             image = self.transform(image)
         return image, self.labels[index]
 
+    def __len__(self):
+        return len(self.image_files)
+
 
 class GTA_Test(Dataset):
     def __init__(self, image_path, labels, transform=None, count=-1):
@@ -396,42 +511,42 @@ def get_gta_globs():
 
 class Waterbird(torch.utils.data.Dataset):
     def __init__(self, root, df, transform, train=True, count_train_landbg=-1, count_train_waterbg=-1, mode='bg_all',
-                 count=-1, return_num=2):
+                 count=-1, return_num=2, index_cache_dir=None):
         self.transform = transform
         self.train = train
         self.df = df
-        lb_on_l = df[(df['y'] == 0) & (df['place'] == 0)]
-        lb_on_w = df[(df['y'] == 0) & (df['place'] == 1)]
-        self.normal_paths = []
-        self.labels = []
         self.return_num = return_num
+        if mode not in ['bg_all', 'bg_water', 'bg_land']:
+            print('Wrong mode!')
+            raise ValueError('Wrong bg mode!')
+
+        def build():
+            lb_on_l = df[(df['y'] == 0) & (df['place'] == 0)]
+            lb_on_w = df[(df['y'] == 0) & (df['place'] == 1)]
+            normal_paths = [os.path.join(root, x) for x in lb_on_l['img_filename'].iloc[:count_train_landbg]]
+            normal_paths += [os.path.join(root, x) for x in lb_on_w['img_filename'].iloc[:count_train_waterbg]]
+            if train:
+                return {'normal_paths': normal_paths, 'image_paths': normal_paths, 'labels': [0] * len(normal_paths)}
 
-        normal_df = lb_on_l.iloc[:count_train_landbg]
-        normal_df_np = normal_df['img_filename'].to_numpy()
-        self.normal_paths.extend([os.path.join(root, x) for x in normal_df_np][:count_train_landbg])
-        normal_df = lb_on_w.iloc[:count_train_waterbg]
-        normal_df_np = normal_df['img_filename'].to_numpy()
-        self.normal_paths.extend([os.path.join(root, x) for x in normal_df_np][:count_train_waterbg])
-
-        if train:
-            self.image_paths = self.normal_paths
-        else:
-            self.image_paths = []
             if mode == 'bg_all':
                 dff = df
             elif mode == 'bg_water':
                 dff = df[(df['place'] == 1)]
-            elif mode == 'bg_land':
-                dff = df[(df['place'] == 0)]
             else:
-                print('Wrong mode!')
-                raise ValueError('Wrong bg mode!')
-            all_paths = dff[['img_filename', 'y']].to_numpy()
-            for i in range(len(all_paths)):
-                full_path = os.path.join(root, all_paths[i][0])
-                if full_path not in self.normal_paths:
-                    self.image_paths.append(full_path)
-                    self.labels.append(all_paths[i][1])
+                dff = df[(df['place'] == 0)]
+            normal_set = set(normal_paths)  # O(1) membership instead of a scan of the list per row
+            test_rows = [(path, int(y)) for path, y in
+                         zip([os.path.join(root, x) for x in dff['img_filename']], dff['y'])
+                         if path not in normal_set]
+            return {'normal_paths': normal_paths,
+                    'image_paths': [path for path, _ in test_rows], 'labels': [y for _, y in test_rows]}
+
+        config = {'root': root, 'df': get_dataframe_digest(df), 'train': train, 'mode': mode,
+                  'count_train_landbg': count_train_landbg, 'count_train_waterbg': count_train_waterbg}
+        index = cached_index(index_cache_dir, 'waterbird', config, build)
+        self.normal_paths = index['normal_paths']
+        self.image_paths = index['image_paths']
+        self.labels = index['labels']
 
     def __len__(self):
         return len(self.image_paths)
@@ -444,55 +559,85 @@ class Waterbird(torch.utils.data.Dataset):
 
         return img, target
 
-def prepare_br35h_dataset_files():
+def sync_dataset_files(layout, out_root, seed, mode='copy'):
+    """Make `out_root` hold exactly `layout` ({relative destination: source file}), touching only changes.
+
+    A manifest (source, size and mtime of every file, split seed, link mode) is kept in
+    out_root/manifest.json; a destination is (re)placed only when its entry changed, and
+    files no longer in the layout are removed. `mode` is 'copy', 'hardlink' or 'symlink'.
+    """
+    import json
+    manifest_path = os.path.join(out_root, 'manifest.json')
+    old_files = dict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['mode'] == mode:
+            old_files = manifest['files']
+
+    files = dict()
+    n_changed = 0
+    for dst, src in layout.items():
+        stat = os.stat(src)
+        files[dst] = [src, stat.st_size, stat.st_mtime_ns]
+        dst_path = os.path.join(out_root, dst)
+        if old_files.get(dst) == files[dst] and os.path.lexists(dst_path):
+            continue
+        Path(os.path.dirname(dst_path)).mkdir(parents=True, exist_ok=True)
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        if mode == 'hardlink':
+            os.link(src, dst_path)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst_path)
+        else:
+            shutil.copy2(src, dst_path)
+        n_changed += 1
+
+    # files of a previous layout (other seed or source list) must not leak into the splits
+    dst_dirs = set(os.path.dirname(dst) for dst in layout.keys()) | set(os.path.dirname(dst) for dst in old_files)
+    n_removed = 0
+    for dst_dir in dst_dirs:
+        if not os.path.isdir(os.path.join(out_root, dst_dir)):
+            continue
+        for f in os.listdir(os.path.join(out_root, dst_dir)):
+            if os.path.join(dst_dir, f) not in files:
+                os.remove(os.path.join(out_root, dst_dir, f))
+                n_removed += 1
+
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump({'seed': seed, 'mode': mode, 'files': files}, f)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    print(f'{out_root}: {len(files)} files, {n_changed} updated, {n_removed} removed')
+
+
+def prepare_br35h_dataset_files(seed=0, mode='copy'):
     normal_path35 = '/kaggle/input/brain-tumor-detection/no'
     anomaly_path35 = '/kaggle/input/brain-tumor-detection/yes'
 
-    print(f"len(os.listdir(normal_path35)): {len(os.listdir(normal_path35))}")
-    print(f"len(os.listdir(anomaly_path35)): {len(os.listdir(anomaly_path35))}")
-
-    print('cnt')
-
-    Path('./Br35H/dataset/test/anomaly').mkdir(parents=True, exist_ok=True)
-
-    flist = [f for f in os.listdir('./Br35H/dataset/test/anomaly')]
-    for f in flist:
-        os.remove(os.path.join('./Br35H/dataset/test/anomaly', f))
+    anom35 = sorted(os.listdir(anomaly_path35))
+    normal35 = sorted(os.listdir(normal_path35))
+    print(f"len(os.listdir(normal_path35)): {len(normal35)}")
+    print(f"len(os.listdir(anomaly_path35)): {len(anom35)}")
 
-    anom35 = os.listdir(anomaly_path35)
-    for f in anom35:
-        shutil.copy2(os.path.join(anomaly_path35, f), './Br35H/dataset/test/anomaly')
-
-
-    normal35 = os.listdir(normal_path35)
-    random.shuffle(normal35)
+    random.Random(seed).shuffle(normal35)  # seeded: re-runs reproduce the same split
     ratio = 0.7
     sep = round(len(normal35) * ratio)
 
-    Path('./Br35H/dataset/test/normal').mkdir(parents=True, exist_ok=True)
-    Path('./Br35H/dataset/train/normal').mkdir(parents=True, exist_ok=True)
-
-    flist = [f for f in os.listdir('./Br35H/dataset/test/normal')]
-    for f in flist:
-        os.remove(os.path.join('./Br35H/dataset/test/normal', f))
-
-    flist = [f for f in os.listdir('./Br35H/dataset/train/normal')]
-    for f in flist:
-        os.remove(os.path.join('./Br35H/dataset/train/normal', f))
-
+    layout = dict()
+    for f in anom35:
+        layout[os.path.join('dataset/test/anomaly', f)] = os.path.join(anomaly_path35, f)
     for f in normal35[:sep]:
-        shutil.copy2(os.path.join(normal_path35, f), './Br35H/dataset/train/normal')
+        layout[os.path.join('dataset/train/normal', f)] = os.path.join(normal_path35, f)
     for f in normal35[sep:]:
-        shutil.copy2(os.path.join(normal_path35, f), './Br35H/dataset/test/normal')
+        layout[os.path.join('dataset/test/normal', f)] = os.path.join(normal_path35, f)
+    sync_dataset_files(layout, './Br35H', seed, mode=mode)
 
 
-def prepare_brats2015_dataset_files():
+def prepare_brats2015_dataset_files(seed=0, mode='copy'):
     import pandas as pd
     labels = pd.read_csv('/kaggle/input/brain-tumor/Brain Tumor.csv')
-    labels = labels[['Image', 'Class']]
-    labels.tail() # 0: no tumor, 1: tumor
-
-    labels.head()
+    labels = labels[['Image', 'Class']]  # 0: no tumor, 1: tumor
 
     brats_path = '/kaggle/input/brain-tumor/Brain Tumor/Brain Tumor'
     lbl = dict(zip(labels.Image, labels.Class))
@@ -501,35 +646,18 @@ def prepare_brats2015_dataset_files():
     normalbrats = [x for x in keys if lbl[x] == 0]
     anomalybrats = [x for x in keys if lbl[x] == 1]
 
-    Path('./brats/dataset/test/anomaly').mkdir(parents=True, exist_ok=True)
-    Path('./brats/dataset/test/normal').mkdir(parents=True, exist_ok=True)
-    Path('./brats/dataset/train/normal').mkdir(parents=True, exist_ok=True)
-
-    flist = [f for f in os.listdir('./brats/dataset/test/anomaly')]
-    for f in flist:
-        os.remove(os.path.join('./brats/dataset/test/anomaly', f))
-
-    flist = [f for f in os.listdir('./brats/dataset/test/normal')]
-    for f in flist:
-        os.remove(os.path.join('./brats/dataset/test/normal', f))
-
-    flist = [f for f in os.listdir('./brats/dataset/train/normal')]
-    for f in flist:
-        os.remove(os.path.join('./brats/dataset/train/normal', f))
-
     ratio = 0.7
-    random.shuffle(normalbrats)
+    random.Random(seed).shuffle(normalbrats)
     bratsep = round(len(normalbrats) * ratio)
 
+    layout = dict()
     for f in anomalybrats:
-        ext = f'{f}.jpg'
-        shutil.copy2(os.path.join(brats_path, ext), './brats/dataset/test/anomaly')
+        layout[os.path.join('dataset/test/anomaly', f'{f}.jpg')] = os.path.join(brats_path, f'{f}.jpg')
     for f in normalbrats[:bratsep]:
-        ext = f'{f}.jpg'
-        shutil.copy2(os.path.join(brats_path, ext), './brats/dataset/train/normal')
+        layout[os.path.join('dataset/train/normal', f'{f}.jpg')] = os.path.join(brats_path, f'{f}.jpg')
     for f in normalbrats[bratsep:]:
-        ext = f'{f}.jpg'
-        shutil.copy2(os.path.join(brats_path, ext), './brats/dataset/test/normal')
+        layout[os.path.join('dataset/test/normal', f'{f}.jpg')] = os.path.join(brats_path, f'{f}.jpg')
+    sync_dataset_files(layout, './brats', seed, mode=mode)
 
 
 class BrainTest(torch.utils.data.Dataset):
@@ -575,6 +703,7 @@ class BrainTrain(torch.utils.data.Dataset):
         random.seed(1)
         random_brats_images = random.sample(brats_mod, 50)
         self.image_paths.extend(random_brats_images)
+        self.labels = [0] * len(self.image_paths)
 
     def __len__(self):
         return len(self.image_paths)
@@ -597,7 +726,8 @@ def three_digits(a: int):
 import pandas as pd
 class WBCDataset(torch.utils.data.Dataset):
     def __init__(self, root1, root2,
-                 labels1: pd.DataFrame, labels2: pd.DataFrame, transform=None, train=True, test_id=1, ratio=0.7):
+                 labels1: pd.DataFrame, labels2: pd.DataFrame, transform=None, train=True, test_id=1, ratio=0.7,
+                 index_cache_dir=None):
         self.transform = transform
         self.root1 = root1
         self.root2 = root2
@@ -619,22 +749,31 @@ class WBCDataset(torch.utils.data.Dataset):
         if self.train:
             self.image_paths = self.train_paths
             self.targets = [0] * len(self.image_paths)
-        else:
+            return
+
+        def image_id(path):
+            return int(os.path.basename(path).split('.')[0])
+
+        def build():
+            # one id -> label lookup table instead of a DataFrame filter per image
             if self.test_id == 1:
-                all_images = glob(os.path.join(root1, '*.bmp'))
-                self.image_paths = [x for x in all_images if x not in self.train_paths]
-                self.image_paths = [x for x in self.image_paths if
-                                    int(os.path.basename(x).split('.')[0]) in labels1['image ID'].values]
-                ids = [os.path.basename(x).split('.')[0] for x in self.image_paths]
-                ids_labels = list(labels1[labels1['image ID'] == int(x)]['class label'] for x in ids)
-                self.targets = [0 if x.item() == 1 else 1 for x in ids_labels]
+                train_set = set(self.train_paths)
+                id_labels = dict(zip(labels1['image ID'], labels1['class label']))
+                image_paths = [x for x in glob(os.path.join(root1, '*.bmp'))
+                               if x not in train_set and image_id(x) in id_labels]
             else:
-                self.image_paths = glob(os.path.join(root2, '*.bmp'))
-                self.image_paths = [x for x in self.image_paths if int(os.path.basename(x).split('.')[0])
-                                    in labels2['image ID'].values]
-                self.targets = [
-                    0 if labels2[labels2['image ID'] == int(os.path.basename(x).split('.')[0])]['class'].item() == 1
-                    else 1 for x in self.image_paths]
+                id_labels = dict(zip(labels2['image ID'], labels2['class']))
+                image_paths = [x for x in glob(os.path.join(root2, '*.bmp')) if image_id(x) in id_labels]
+            targets = [0 if id_labels[image_id(x)] == 1 else 1 for x in image_paths]
+            return {'image_paths': image_paths, 'targets': targets}
+
+        root = root1 if self.test_id == 1 else root2
+        config = {'root1': root1, 'root2': root2, 'test_id': self.test_id, 'ratio': ratio,
+                  'labels1': get_dataframe_digest(labels1), 'labels2': get_dataframe_digest(labels2),
+                  'root_mtime': os.path.getmtime(root)}  # a file added to or removed from root changes its mtime
+        index = cached_index(index_cache_dir, 'wbc', config, build)
+        self.image_paths = index['image_paths']
+        self.targets = index['targets']
 
     def __len__(self):
         return len(self.image_paths)
@@ -645,14 +784,124 @@ class WBCDataset(torch.utils.data.Dataset):
         if self.transform is not None:
             img = self.transform(img)
 
-        height = img.shape[1]
-        width = img.shape[2]
         target = 0 if self.train else self.targets[idx]
 
         return img, target
 
 
 
+class NumpyImageDataset(Dataset):
+    """(N, H, W, 3) uint8 .npy of images, e.g. written by datasets/fix_preprocess.py; every label is 0.
+
+    Without a transform, samples are (3, H, W) float tensors in [0, 1] (ToTensor of the
+    stored images); otherwise the transform is applied to the image as a PIL image.
+    """
+
+    def __init__(self, data_path, transform=None):
+        self.data_path = data_path
+        self.data = np.load(data_path, mmap_mode='r')
+        self.targets = np.zeros(len(self.data), dtype=np.int64)
+        self.transform = transform
+
+    def __getitem__(self, index):
+        if self.transform is not None:
+            return self.transform(Image.fromarray(np.asarray(self.data[index]))), 0
+        return torch.from_numpy(np.array(self.data[index])).permute(2, 0, 1).float().div(255), 0
+
+    def __getitems__(self, indices):
+        if self.transform is not None:
+            return [self[i] for i in indices]
+        # batched path of the DataLoader: one read per batch
+        x = torch.from_numpy(self.data[np.sort(indices)]).permute(0, 3, 1, 2).float().div(255)
+        x = x[np.argsort(np.argsort(indices))]
+        return [(x_i, 0) for x_i in x]
+
+    def __len__(self):
+        return len(self.data)
+
+
+# ImageFolder OOD benchmarks: directory under DATA_PATH, number of images kept (None: all)
+OOD_BENCHMARKS = {
+    'lsun_resize': ('LSUN_resize', None),
+    'imagenet_resize': ('Imagenet_resize', None),
+    'stanford_dogs': ('stanford_dogs', 3000),
+    'cub': ('cub200', 3000),
+    'flowers102': ('flowers102', 3000),
+    'places365': ('places365', 3000),
+    'food_101': (os.path.join('food-101', 'images'), 3000),
+    'caltech_256': ('caltech-256', 3000),
+    'dtd': (os.path.join('dtd', 'images'), 3000),
+    'pets': ('pets', 3000),
+}
+PACKED_PATH = os.path.join(DATA_PATH, 'packed')  # output of datasets/ood_pack.py
+
+
+class PackedImageDataset(Dataset):
+    """Encoded image files packed back to back in `path`.bin, with `path`.json as index.
+
+    Opening it reads only the index; each sample decodes its own byte range, as the
+    ImageFolder loader would decode the original file.
+    """
+
+    def __init__(self, path, transform=None):
+        import json
+        with open(f'{path}.json') as f:
+            self.index = json.load(f)
+        self.data_path = f'{path}.bin'
+        self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        self.offsets = np.asarray(self.index['offsets'], dtype=np.int64)  # (N + 1,)
+        self.targets = np.asarray(self.index['targets'], dtype=np.int64)
+        self.transform = transform
+
+    def __getitem__(self, index):
+        import io
+        data = self.data[self.offsets[index]:self.offsets[index + 1]]
+        image = Image.open(io.BytesIO(data.tobytes())).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index].item()
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def get_ood_benchmark(dataset, test_transform):
+    """The kept images of an ImageFolder OOD benchmark, from its pack when datasets/ood_pack.py made one."""
+    test_dir, length = OOD_BENCHMARKS[dataset]
+    pack_path = os.path.join(PACKED_PATH, dataset)
+    if not os.path.exists(f'{pack_path}.json'):
+        test_set = datasets.ImageFolder(os.path.join(DATA_PATH, test_dir), transform=test_transform)
+        if length is not None:
+            test_set = get_subset_with_len(test_set, length=length, shuffle=True)
+        return test_set
+
+    test_set = PackedImageDataset(pack_path, transform=test_transform)
+    if length is not None:
+        # same random draws as the ImageFolder path, so the global RNG state afterwards is unchanged
+        get_subset_indices(test_set.index['num_files'], length, shuffle=True)
+    return test_set
+
+
+def get_fix_dataset(test_dir, image_size, test_transform):
+    """LSUN_fix / Imagenet_fix from the `test_dir`.npy shard if present, else from the PNG folder."""
+    if not os.path.exists(f'{test_dir}.npy'):
+        return datasets.ImageFolder(test_dir, transform=test_transform)
+    test_set = NumpyImageDataset(f'{test_dir}.npy')
+    if test_set.data.shape[1:3] != tuple(image_size[:2]):  # the shard is stored at 32x32
+        test_set.transform = test_transform
+    return test_set
+
+
+def get_test_split(P, splits):
+    """Build only the test split selected by P.test_id.
+
+    `splits` maps a test_id (1: in-domain, 2: shifted) to a function building that split,
+    so the other split's files are never globbed, read or decoded.
+    """
+    test_id = 2 if P.test_id == 2 else 1
+    return splits[test_id]()
+
+
 def get_dataset(P, dataset, test_only=False, image_size=None, download=False, eval=False):
     download = True
     image_size = (P.image_size, P.image_size, 3)
@@ -661,7 +910,8 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
                    'places365', 'food_101', 'caltech_256', 'dtd', 'pets']:
         if eval:
             train_transform, test_transform = get_simclr_eval_transform_imagenet(P.ood_samples,
-                                                                                 P.resize_factor, P.resize_fix)
+                                                                                 P.resize_factor, P.resize_fix,
+                                                                                 batched=P.batched_crops)
         else:
             train_transform, test_transform = get_transform_imagenet()
     elif dataset == 'fmnist':
@@ -709,58 +959,64 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
     elif dataset == 'fmnist':
         image_size = (224, 224, 3)
         n_classes = 2
-        test_set = FMNIST_Dataset(train=False, transform=test_transform, test_id=1)
-        test_set2 = FMNIST_Dataset(train=False, transform=test_transform, test_id=2)
-        if P.test_id == 2:
-            test_set = test_set2
+        test_set = get_test_split(P, {
+            1: lambda: FMNIST_Dataset(train=False, transform=test_transform, test_id=1),
+            2: lambda: FMNIST_Dataset(train=False, transform=test_transform, test_id=2),
+        })
         train_set = FMNIST_Dataset(train=True, transform=train_transform)
     elif dataset == 'mn':
         image_size = (224, 224, 3)
         n_classes = 2
-        test_set = MNIST_Dataset(train=False, transform=test_transform, test_id=1)
-        test_set2 = MNIST_Dataset(train=False, transform=test_transform, test_id=2)
-        if P.test_id == 2:
-            test_set = test_set2
+        test_set = get_test_split(P, {
+            1: lambda: MNIST_Dataset(train=False, transform=test_transform, test_id=1),
+            2: lambda: MNIST_Dataset(train=False, transform=test_transform, test_id=2),
+        })
         train_set = MNIST_Dataset(train=True, transform=train_transform)
     elif dataset == 'wbc':
         n_classes = 2
         import pandas as pd
         df1 = pd.read_csv('/kaggle/working/segmentation_WBC/Class Labels of Dataset 1.csv')
         df2 = pd.read_csv('/kaggle/working/segmentation_WBC/Class Labels of Dataset 2.csv')
-        test_set = WBCDataset('/kaggle/working/segmentation_WBC/Dataset 1',
-                               '/kaggle/working/segmentation_WBC/Dataset 2',
-                               df1, df2, transform=train_transform, train=False, test_id=1)
-        if P.test_id == 2:
-            test_set = WBCDataset('/kaggle/working/segmentation_WBC/Dataset 1',
-                               '/kaggle/working/segmentation_WBC/Dataset 2',
-                               df1, df2, transform=test_transform, train=False, test_id=2)
+        test_set = get_test_split(P, {
+            1: lambda: WBCDataset('/kaggle/working/segmentation_WBC/Dataset 1',
+                                  '/kaggle/working/segmentation_WBC/Dataset 2',
+                                  df1, df2, transform=train_transform, train=False, test_id=1,
+                                  index_cache_dir=P.shard_cache_dir),
+            2: lambda: WBCDataset('/kaggle/working/segmentation_WBC/Dataset 1',
+                                  '/kaggle/working/segmentation_WBC/Dataset 2',
+                                  df1, df2, transform=test_transform, train=False, test_id=2,
+                                  index_cache_dir=P.shard_cache_dir),
+        })
         train_set = WBCDataset('/kaggle/working/segmentation_WBC/Dataset 1',
                                '/kaggle/working/segmentation_WBC/Dataset 2',
-                               df1, df2, transform=test_transform, train=True)
+                               df1, df2, transform=test_transform, train=True,
+                               index_cache_dir=P.shard_cache_dir)
     elif dataset == 'brain':
         if P.brain_prepared == 0:
-            prepare_br35h_dataset_files()
-            prepare_brats2015_dataset_files()
+            prepare_br35h_dataset_files(seed=P.brain_split_seed, mode=P.brain_link_mode)
+            prepare_brats2015_dataset_files(seed=P.brain_split_seed, mode=P.brain_link_mode)
             P.brain_prepared = 1
         n_classes = 2
         train_set = BrainTrain(transform=train_transform)
-        test_set = BrainTest(transform=test_transform, test_id=1)
-        if P.test_id == 2:
-            test_set = BrainTest(transform=test_transform, test_id=2)
+        test_set = get_test_split(P, {
+            1: lambda: BrainTest(transform=test_transform, test_id=1),
+            2: lambda: BrainTest(transform=test_transform, test_id=2),
+        })
     elif dataset == 'waterbirds':
         n_classes = 2
         import pandas as pd
         df = pd.read_csv('/kaggle/input/waterbird/waterbird/metadata.csv')
         train_set = Waterbird(root='/kaggle/input/waterbird/waterbird', df=df,
                                        transform=train_transform, train=True, count_train_landbg=3500,
-                                       count_train_waterbg=100)
-        test_set = Waterbird(root='/kaggle/input/waterbird/waterbird', df=df,
-                                       transform=test_transform, train=False, count_train_landbg=3500,
-                                       count_train_waterbg=100, mode='bg_land')
-        if P.test_id == 2:
-            test_set = Waterbird(root='/kaggle/input/waterbird/waterbird', df=df,
-                                       transform=test_transform, train=False, count_train_landbg=3500,
-                                       count_train_waterbg=100, mode='bg_water')
+                                       count_train_waterbg=100, index_cache_dir=P.shard_cache_dir)
+        test_set = get_test_split(P, {
+            1: lambda: Waterbird(root='/kaggle/input/waterbird/waterbird', df=df,
+                                 transform=test_transform, train=False, count_train_landbg=3500,
+                                 count_train_waterbg=100, mode='bg_land', index_cache_dir=P.shard_cache_dir),
+            2: lambda: Waterbird(root='/kaggle/input/waterbird/waterbird', df=df,
+                                 transform=test_transform, train=False, count_train_landbg=3500,
+                                 count_train_waterbg=100, mode='bg_water', index_cache_dir=P.shard_cache_dir),
+        })
     elif dataset == 'isic':
         # image_size = (32, 32, 3)
         n_classes = 2
@@ -768,42 +1024,49 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
         import pandas as pd
         train_path = glob('/kaggle/input/isic-task3-dataset/dataset/train/NORMAL/*')
         train_label = [0] * len(train_path)
-        test_anomaly_path = glob('/kaggle/input/isic-task3-dataset/dataset/test/ABNORMAL/*')
-        test_anomaly_label = [1] * len(test_anomaly_path)
-        test_normal_path = glob('/kaggle/input/isic-task3-dataset/dataset/test/NORMAL/*')
-        test_normal_label = [0] * len(test_normal_path)
 
-        test_label = test_anomaly_label + test_normal_label
-        test_path = test_anomaly_path + test_normal_path
+        def isic_test():
+            test_anomaly_path = glob('/kaggle/input/isic-task3-dataset/dataset/test/ABNORMAL/*')
+            test_anomaly_label = [1] * len(test_anomaly_path)
+            test_normal_path = glob('/kaggle/input/isic-task3-dataset/dataset/test/NORMAL/*')
+            test_normal_label = [0] * len(test_normal_path)
+
+            test_label = test_anomaly_label + test_normal_label
+            test_path = test_anomaly_path + test_normal_path
+            return ISIC2018(image_path=test_path, labels=test_label, transform=test_transform)
 
-        df = pd.read_csv('/kaggle/input/pad-ufes-20/PAD-UFES-20/metadata.csv')
+        def pad_ufes_test():
+            df = pd.read_csv('/kaggle/input/pad-ufes-20/PAD-UFES-20/metadata.csv')
 
-        shifted_test_label = df["diagnostic"].to_numpy()
-        shifted_test_label = (shifted_test_label != "NEV")
-        # shifted_test_label = [0 if shifted_test_label[i] is False else 1 for i in range(len(shifted_test_label))]
+            shifted_test_label = df["diagnostic"].to_numpy()
+            shifted_test_label = (shifted_test_label != "NEV")
+            # shifted_test_label = [0 if shifted_test_label[i] is False else 1 for i in range(len(shifted_test_label))]
 
-        shifted_test_path = df["img_id"].to_numpy()
-        shifted_test_path = '/kaggle/input/pad-ufes-20/PAD-UFES-20/Dataset/' + shifted_test_path
+            shifted_test_path = df["img_id"].to_numpy()
+            shifted_test_path = '/kaggle/input/pad-ufes-20/PAD-UFES-20/Dataset/' + shifted_test_path
+            return ISIC2018(image_path=shifted_test_path, labels=shifted_test_label, transform=test_transform)
 
         train_set = ISIC2018(image_path=train_path, labels=train_label, transform=train_transform)
-        test_set = ISIC2018(image_path=test_path, labels=test_label, transform=test_transform)
-        if P.test_id == 2:
-            test_set = ISIC2018(image_path=shifted_test_path, labels=shifted_test_label, transform=test_transform)
+        test_set = get_test_split(P, {1: isic_test, 2: pad_ufes_test})
     elif dataset == 'gta':
         n_classes = 2
         normal_path_train, normal_path_test, anomaly_path = get_cityscape_globs()
-        test_path = normal_path_test + anomaly_path
-        test_label = [0] * len(normal_path_test) + [1] * len(anomaly_path)
         train_label = [0] * len(normal_path_train)
-        glob_train_id, glob_test_id, glob_ood = get_gta_globs()
         train_set = GTA(image_path=normal_path_train, labels=train_label,
                         transform=train_transform)
-        test_set = GTA_Test(image_path=test_path, labels=test_label,
+
+        def gta_test():
+            _, glob_test_id, glob_ood = get_gta_globs()  # 20 directory globs, only for this split
+            return GTA_Test(image_path=glob_test_id + glob_ood,
+                            labels=[0] * len(glob_test_id) + [1] * len(glob_ood),
                             transform=test_transform)
-        if P.test_id == 2:
-            test_set = GTA_Test(image_path=glob_test_id + glob_ood,
-                                labels=[0] * len(glob_test_id) + [1] * len(glob_ood),
-                                transform=test_transform)
+
+        test_set = get_test_split(P, {
+            1: lambda: GTA_Test(image_path=normal_path_test + anomaly_path,
+                                labels=[0] * len(normal_path_test) + [1] * len(anomaly_path),
+                                transform=test_transform),
+            2: gta_test,
+        })
 
     elif dataset == 'svhn':
         image_size = (32, 32, 3)
@@ -899,26 +1162,20 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
         test_set = datasets.CIFAR100(DATA_PATH, train=False, download=download, transform=test_transform)
     elif dataset == 'cifar10-corruption':
         n_classes = 10
-        transform = transforms.Compose([
-            transforms.Resize(32),
-            transforms.ToTensor(),
-        ])
-        test_set = CIFAR_CORRUCPION(transform=transform, cifar_corruption_data=P.cifar_corruption_data)
-        train_set = datasets.CIFAR10(DATA_PATH, train=True, download=download, transform=transform)
+        test_set = CIFAR_CORRUCPION(cifar_corruption_data=P.cifar_corruption_data,
+                                    severity=P.cifar_corruption_severity,
+                                    corruption_types=P.cifar_corruption_types)
+        train_set = get_cifar_corruption_train_set(dataset, download=download)
         print("train_set shapes: ", train_set[0][0].shape)
         print("test_set shapes: ", test_set[0][0].shape)
 
     elif dataset == 'cifar100-corruption':
         n_classes = 100
-        transform = transforms.Compose([
-            transforms.Resize(32),
-            transforms.ToTensor(),
-        ])
-        test_set = CIFAR_CORRUCPION(transform=transform, cifar_corruption_label='CIFAR-100-C/labels.npy',
-                                    cifar_corruption_data=P.cifar_corruption_data)
-        train_set = datasets.CIFAR100(DATA_PATH, train=True, download=download, transform=transform)
-
-        train_set.targets = sparse2coarse(train_set.targets)
+        test_set = CIFAR_CORRUCPION(cifar_corruption_label='CIFAR-100-C/labels.npy',
+                                    cifar_corruption_data=P.cifar_corruption_data,
+                                    severity=P.cifar_corruption_severity,
+                                    corruption_types=P.cifar_corruption_types)
+        train_set = get_cifar_corruption_train_set(dataset, download=download)
 
         print("train_set shapes: ", train_set[0][0].shape)
         print("test_set shapes: ", test_set[0][0].shape)
@@ -927,25 +1184,13 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
         assert test_only and image_size is not None
         test_set = datasets.SVHN(DATA_PATH, split='test', download=download, transform=test_transform)
 
-    elif dataset == 'lsun_resize':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'LSUN_resize')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-
     elif dataset == 'lsun_pil' or dataset == 'lsun_fix':
         assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'LSUN_fix')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-
-    elif dataset == 'imagenet_resize':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'Imagenet_resize')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
+        test_set = get_fix_dataset(os.path.join(DATA_PATH, 'LSUN_fix'), image_size, test_transform)
 
     elif dataset == 'imagenet_pil' or dataset == 'imagenet_fix':
         assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'Imagenet_fix')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
+        test_set = get_fix_dataset(os.path.join(DATA_PATH, 'Imagenet_fix'), image_size, test_transform)
 
     elif dataset == 'imagenet':
         image_size = (224, 224, 3)
@@ -955,63 +1200,44 @@ def get_dataset(P, dataset, test_only=False, image_size=None, download=False, ev
         train_set = datasets.ImageFolder(train_dir, transform=train_transform)
         test_set = datasets.ImageFolder(test_dir, transform=test_transform)
 
-    elif dataset == 'stanford_dogs':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'stanford_dogs')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'cub':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'cub200')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'flowers102':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'flowers102')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'places365':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'places365')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'food_101':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'food-101', 'images')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'caltech_256':
+    elif dataset in OOD_BENCHMARKS:
         assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'caltech-256')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'dtd':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'dtd', 'images')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
-
-    elif dataset == 'pets':
-        assert test_only and image_size is not None
-        test_dir = os.path.join(DATA_PATH, 'pets')
-        test_set = datasets.ImageFolder(test_dir, transform=test_transform)
-        test_set = get_subset_with_len(test_set, length=3000, shuffle=True)
+        test_set = get_ood_benchmark(dataset, test_transform)
 
     else:
         raise NotImplementedError()
 
+    if P.shard_cache_dir is not None and dataset in SHARD_CACHE_DATASETS:
+        test_set = get_shard_cached_dataset(P, dataset, test_set, image_size, 'test')
+        if not test_only:
+            train_set = get_shard_cached_dataset(P, dataset, train_set, image_size, 'train')
+
     if test_only:
         return test_set
     else:
         return train_set, test_set, image_size, n_classes
 
 
+def get_cifar_corruption_train_set(dataset, download=True):
+    """Clean train set of a CIFAR-C benchmark (its test set is a CIFAR_CORRUCPION)."""
+    transform = transforms.Compose([
+        transforms.Resize(32),
+        transforms.ToTensor(),
+    ])
+    if dataset == 'cifar10-corruption':
+        return datasets.CIFAR10(DATA_PATH, train=True, download=download, transform=transform)
+    train_set = datasets.CIFAR100(DATA_PATH, train=True, download=download, transform=transform)
+    train_set.targets = sparse2coarse(train_set.targets)
+    return train_set
+
+
+def get_shard_cached_dataset(P, dataset, data_set, image_size, split):
+    """Serve a file-based dataset from its uint8 shard under P.shard_cache_dir."""
+    test_id = P.test_id if split == 'test' else 0
+    return ShardCachedDataset(data_set, get_dataset_labels(data_set), P.shard_cache_dir, dataset,
+                              image_size[0], split, test_id=test_id)
+
+
 def get_superclass_list(dataset):
     if dataset == 'cifar10' or dataset == 'cifar10-corruption' or dataset == 'svhn' or dataset == 'svhn-10-corruption' or dataset == 'svhn-10' or dataset == 'fashion-mnist' or dataset == 'mnist':
         return CIFAR10_SUPERCLASS
@@ -1031,26 +1257,85 @@ def get_subclass_dataset(dataset, classes):
     if not isinstance(classes, list):
         classes = [classes]
 
-    indices = []
-    try:
-        for idx, tgt in enumerate(dataset.targets):
-            if tgt in classes:
-                indices.append(idx)
-    except:
-        # SVHN
-        for idx, (_, tgt) in enumerate(dataset):
-            if tgt in classes:
-                indices.append(idx)
+    labels = load_dataset_labels(dataset)
+    indices = np.nonzero(np.isin(labels, classes))[0].tolist()
 
     dataset = Subset(dataset, indices)
     return dataset
 
 
-def get_simclr_eval_transform_imagenet(sample_num, resize_factor, resize_fix):
+def get_dataset_labels(dataset):
+    """Return the labels of `dataset` as a numpy array without decoding any sample.
+
+    Labels come from dataset-level arrays (`targets`, `labels`, ...) or a label-only
+    `get_label(index)` hook; Subset, ConcatDataset, TensorDataset and other wrappers
+    holding `dataset` (and optionally `indices`) are resolved structurally. Returns
+    None when neither is available.
+    """
+    if isinstance(dataset, Subset):
+        labels = get_dataset_labels(dataset.dataset)
+        if labels is None:
+            return None
+        return labels[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, ConcatDataset):
+        labels = [get_dataset_labels(d) for d in dataset.datasets]
+        if any(l is None for l in labels):
+            return None
+        return np.concatenate(labels)
+    if isinstance(dataset, TensorDataset) and len(dataset.tensors) > 1:
+        return dataset.tensors[1].numpy()
+
+    for attr in ['targets', 'labels', 'test_label', 'labels_10']:
+        labels = getattr(dataset, attr, None)
+        if labels is not None and len(labels) == len(dataset):
+            return np.asarray(labels)
+    if callable(getattr(dataset, 'get_label', None)):  # reads the label only, no image
+        return np.asarray([dataset.get_label(i) for i in range(len(dataset))])
+
+    if isinstance(getattr(dataset, 'dataset', None), Dataset):  # wrapper of another dataset
+        labels = get_dataset_labels(dataset.dataset)
+        if labels is None or getattr(dataset, 'indices', None) is None:
+            return labels
+        return labels[np.asarray(dataset.indices, dtype=np.int64)]
+    return None
+
+
+def load_dataset_labels(dataset):
+    """get_dataset_labels, falling back to reading dataset[i][1] of every sample (decodes every image)."""
+    labels = get_dataset_labels(dataset)
+    if labels is None:
+        print(f'{type(dataset).__name__} has no label array, reading every sample')
+        labels = np.asarray([dataset[i][1] for i in range(len(dataset))])
+    return labels
+
+
+def get_loader_unique_label(loader):
+    labels = get_dataset_labels(loader.dataset)
+    if labels is not None:
+        return sorted(np.unique(labels).tolist())
+
+    # no label array: fall back to iterating the loader, which decodes every sample
+    print(f'{type(loader.dataset).__name__} has no label array, iterating the loader')
+    try:
+        unique_labels = set()
+        for _, labels in loader:
+            unique_labels.update(labels.tolist())
+        unique_labels = sorted(list(unique_labels))
+    except:
+        print("can not compute unique loader!")
+        unique_labels = []
+    return unique_labels
+
+
+def get_simclr_eval_transform_imagenet(sample_num, resize_factor, resize_fix, batched=False):
     resize_scale = (resize_factor, 1.0)  # resize scaling factor
     if resize_fix:  # if resize_fix is True, use same scale
         resize_scale = (resize_factor, resize_factor)
 
+    if batched:  # all views of an image in one tensor op
+        transform = MultiCropTransform(sample_num, size=224, resize=256, scale=resize_scale)
+        return transform, transform
+
     transform = transforms.Compose([
         transforms.Resize(256),
         transforms.RandomResizedCrop(224, scale=resize_scale),
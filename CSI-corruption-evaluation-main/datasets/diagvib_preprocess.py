@@ -0,0 +1,42 @@
+"""Convert the DiagViB-6 MNIST / FMNIST pickles into one contiguous .npy per split.
+
+    python -m datasets.diagvib_preprocess --dataset mn fmnist
+
+Writes <split>_images.npy and <split>_labels.npy to DIAGVIB_NPY_PATH/<dataset>, where
+MNIST_Dataset / FMNIST_Dataset memory-map them instead of unpickling.
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from datasets.datasets import DIAGVIB_PATH, DIAGVIB_NPY_PATH, DIAGVIB_SPLITS, load_diagvib_pickles
+
+
+def convert_split(dataset, split):
+    images, labels = load_diagvib_pickles(DIAGVIB_PATH[dataset], split)
+    out_dir = os.path.join(DIAGVIB_NPY_PATH, dataset)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in [('images', images), ('labels', labels)]:
+        path = os.path.join(out_dir, f'{split}_{name}.npy')
+        np.save(f'{path}.tmp.npy', array)
+        os.replace(f'{path}.tmp.npy', path)
+    print(f'{dataset} {split}: images {images.shape} {images.dtype}, {int(labels.sum())} abnormal')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dataset', nargs='+', choices=list(DIAGVIB_PATH.keys()), default=list(DIAGVIB_PATH.keys()))
+    parser.add_argument('--split', nargs='+', choices=list(DIAGVIB_SPLITS.keys()), default=list(DIAGVIB_SPLITS.keys()))
+    args = parser.parse_args()
+
+    for dataset in args.dataset:
+        for split in args.split:
+            check = time.time()
+            convert_split(dataset, split)
+            print(f'Converting time {time.time() - check:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
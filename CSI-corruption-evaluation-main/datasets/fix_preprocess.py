@@ -0,0 +1,63 @@
+"""Shared writer of the LSUN_fix / Imagenet_fix preprocessing scripts.
+
+Images are collected into one preallocated uint8 buffer, quantized exactly as
+torchvision.utils.save_image does, then written as individual PNGs (encoded in a
+process pool) and/or as a single (N, H, W, 3) uint8 .npy shard that
+datasets.NumpyImageDataset serves without decoding.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def collect_images(loader, num_images, out=None):
+    """First `num_images` images of `loader` as a (num_images, H, W, 3) uint8 array (written into `out` if given)."""
+    images = out
+    offset = 0
+    for image, _ in loader:
+        if images is None:
+            images = np.empty((num_images,) + tuple(image.shape[2:]) + (image.size(1),), dtype=np.uint8)
+        n = min(len(image), num_images - offset)
+        # same rounding as save_image, so the PNG and .npy outputs hold identical pixels
+        image = image[:n].mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+        images[offset:offset + n] = image.permute(0, 2, 3, 1).numpy()
+        offset += n
+        if offset == num_images:
+            break
+    assert offset == num_images, f'loader has only {offset} images'
+    return images
+
+
+def _write_pngs(args):
+    images, paths = args
+    for image, path in zip(images, paths):
+        Image.fromarray(image).save(path)
+
+
+def write_pngs(images, out_dir, prefix='correct_resize', num_workers=8, chunk=500):
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [os.path.join(out_dir, f'{prefix}_{i}.png') for i in range(len(images))]
+    jobs = [(images[i:i + chunk], paths[i:i + chunk]) for i in range(0, len(images), chunk)]
+    if num_workers <= 1:
+        list(map(_write_pngs, jobs))
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            list(pool.map(_write_pngs, jobs))
+
+
+def write_shard(images, path):
+    np.save(f'{path}.tmp.npy', images)
+    os.replace(f'{path}.tmp.npy', path)
+
+
+def write_fix_benchmark(images, out_dir, formats=('png',), num_workers=8, prefix='correct_resize'):
+    """Write `images` as out_dir/*.png and/or out_dir.npy."""
+    if 'png' in formats:
+        write_pngs(images, out_dir, prefix=prefix, num_workers=num_workers)
+    if 'npy' in formats:
+        # ImageFolder lists the PNGs by file name (_0, _1, _10, ...); the shard keeps that order
+        order = sorted(range(len(images)), key=lambda i: f'{prefix}_{i}.png')
+        write_shard(images[order], f'{out_dir.rstrip("/")}.npy')
@@ -1,17 +1,16 @@
 import os
 import time
 import random
+from argparse import ArgumentParser
 
-import cv2
 import numpy as np
 import torch
 
-import torch.nn.functional as F
 from torchvision import datasets, transforms
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 
 from datasets import get_subclass_dataset
+from datasets.fix_preprocess import collect_images, write_fix_benchmark
 
 def set_random_seed(seed):
     random.seed(seed)
@@ -21,6 +20,12 @@ def set_random_seed(seed):
 
 IMAGENET_PATH = '~/data/ImageNet'
 
+parser = ArgumentParser()
+parser.add_argument('--out_dir', default='./Imagenet_fix', type=str)
+parser.add_argument('--format', nargs='+', choices=['png', 'npy'], default=['png'])
+parser.add_argument('--num_workers', help='decode and PNG encode processes', default=8, type=int)
+args = parser.parse_args()
+
 
 check = time.time()
 
@@ -41,26 +46,13 @@ set_random_seed(0)
 train_dir = os.path.join(IMAGENET_PATH, 'one_class_train')
 Imagenet_set = datasets.ImageFolder(train_dir, transform=transform)
 Imagenet_set = get_subclass_dataset(Imagenet_set, class_idx_list)
-Imagenet_dataloader = DataLoader(Imagenet_set, batch_size=100, shuffle=True, pin_memory=False)
-
-total_test_image = None
-for n, (test_image, target) in enumerate(Imagenet_dataloader):
-
-    if n == 0:
-        total_test_image = test_image
-    else:
-        total_test_image = torch.cat((total_test_image, test_image), dim=0).cpu()
+Imagenet_dataloader = DataLoader(Imagenet_set, batch_size=100, shuffle=True, pin_memory=False,
+                                 num_workers=args.num_workers)
 
-    if total_test_image.size(0) >= 10000:
-        break
+total_test_image = collect_images(Imagenet_dataloader, 10000)
 
 print (f'Preprocessing time {time.time()-check}')
 
-if not os.path.exists('./Imagenet_fix'):
-    os.mkdir('./Imagenet_fix')
-
 check = time.time()
-for i in range(10000):
-    save_image(total_test_image[i], f'Imagenet_fix/correct_resize_{i}.png')
+write_fix_benchmark(total_test_image, args.out_dir, formats=args.format, num_workers=args.num_workers)
 print (f'Saving time {time.time()-check}')
-
@@ -1,13 +1,14 @@
-import os
 import time
 import random
+from argparse import ArgumentParser
 
 import numpy as np
 import torch
 
 from torchvision import datasets, transforms
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
+
+from datasets.fix_preprocess import collect_images, write_fix_benchmark
 
 def set_random_seed(seed):
     random.seed(seed)
@@ -15,6 +16,12 @@ def set_random_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
 
+parser = ArgumentParser()
+parser.add_argument('--out_dir', default='./LSUN_fix', type=str)
+parser.add_argument('--format', nargs='+', choices=['png', 'npy'], default=['png'])
+parser.add_argument('--num_workers', help='decode and PNG encode processes', default=8, type=int)
+args = parser.parse_args()
+
 check = time.time()
 
 transform = transforms.Compose([
@@ -29,33 +36,15 @@ set_random_seed(0)
 LSUN_class_list = ['bedroom', 'bridge', 'church_outdoor', 'classroom',
                    'conference_room', 'dining_room', 'kitchen', 'living_room', 'restaurant', 'tower']
 
-total_test_image_all_class = []
-for LSUN_class in LSUN_class_list:
+per_class = 1000
+total_test_image_all_class = np.empty((per_class * len(LSUN_class_list), 32, 32, 3), dtype=np.uint8)
+for i, LSUN_class in enumerate(LSUN_class_list):
     LSUN_set = datasets.LSUN('~/data/lsun/', classes=LSUN_class + '_train', transform=transform)
-    LSUN_loader = DataLoader(LSUN_set, batch_size=100, shuffle=True, pin_memory=False)
-
-    total_test_image = None
-    for n, (test_image, _) in enumerate(LSUN_loader):
-
-        if n == 0:
-            total_test_image = test_image
-        else:
-            total_test_image = torch.cat((total_test_image, test_image), dim=0).cpu()
-
-        if total_test_image.size(0) >= 1000:
-            break
-
-    total_test_image_all_class.append(total_test_image)
-
-total_test_image_all_class = torch.cat(total_test_image_all_class, dim=0)
+    LSUN_loader = DataLoader(LSUN_set, batch_size=100, shuffle=True, pin_memory=False, num_workers=args.num_workers)
+    collect_images(LSUN_loader, per_class, out=total_test_image_all_class[i * per_class:(i + 1) * per_class])
 
 print (f'Preprocessing time {time.time()-check}')
 
-if not os.path.exists('./LSUN_fix'):
-    os.mkdir('./LSUN_fix')
-
 check = time.time()
-for i in range(10000):
-    save_image(total_test_image_all_class[i], f'LSUN_fix/correct_resize_{i}.png')
+write_fix_benchmark(total_test_image_all_class, args.out_dir, formats=args.format, num_workers=args.num_workers)
 print (f'Saving time {time.time()-check}')
-
@@ -0,0 +1,68 @@
+"""Pack the kept images of the ImageFolder OOD benchmarks into one file each.
+
+    python -m datasets.ood_pack --dataset cub stanford_dogs flowers102 places365 food_101 caltech_256 dtd pets
+
+For every benchmark the directory is scanned once, the images get_dataset keeps
+(the seeded 3000-image subset, or all) are selected, and their encoded bytes are
+written back to back to PACKED_PATH/<dataset>.bin with a .json index of byte
+offsets, targets and source paths. get_dataset then opens the pack instead of
+walking the directory.
+"""
+import os
+import json
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from torchvision import datasets
+
+from datasets.datasets import DATA_PATH, OOD_BENCHMARKS, PACKED_PATH, get_subset_indices
+
+
+def pack_benchmark(dataset):
+    test_dir, length = OOD_BENCHMARKS[dataset]
+    image_folder = datasets.ImageFolder(os.path.join(DATA_PATH, test_dir))
+    num_files = len(image_folder.samples)
+    if length is None:
+        kept = np.arange(num_files)
+    else:
+        kept = get_subset_indices(num_files, length, shuffle=True)
+
+    os.makedirs(PACKED_PATH, exist_ok=True)
+    pack_path = os.path.join(PACKED_PATH, dataset)
+    offsets = [0]
+    with open(f'{pack_path}.bin.tmp', 'wb') as out:
+        for i in kept:
+            with open(image_folder.samples[i][0], 'rb') as f:
+                offsets.append(offsets[-1] + out.write(f.read()))
+
+    index = {
+        'root': os.path.join(DATA_PATH, test_dir),
+        'num_files': num_files,  # size of the directory scan the subset was drawn from
+        'indices': kept.tolist(),
+        'paths': [image_folder.samples[i][0] for i in kept],
+        'targets': [image_folder.samples[i][1] for i in kept],
+        'classes': image_folder.classes,
+        'offsets': offsets,
+    }
+    with open(f'{pack_path}.json.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{pack_path}.bin.tmp', f'{pack_path}.bin')
+    os.replace(f'{pack_path}.json.tmp', f'{pack_path}.json')
+    print(f'{dataset}: {len(kept)} of {num_files} images, {offsets[-1] / 2 ** 20:.1f} MiB')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dataset', nargs='+', choices=list(OOD_BENCHMARKS.keys()),
+                        default=list(OOD_BENCHMARKS.keys()))
+    args = parser.parse_args()
+
+    for dataset in args.dataset:
+        check = time.time()
+        pack_benchmark(dataset)
+        print(f'Packing time {time.time() - check:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
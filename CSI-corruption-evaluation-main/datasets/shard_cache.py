@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+
+
+def get_image_paths(dataset):
+    """Image files of the file-based datasets (ISIC2018, GTA, Waterbird, Brain*, WBCDataset)."""
+    for attr in ['image_files', 'image_paths', 'test_path']:
+        paths = getattr(dataset, attr, None)
+        if paths is not None:
+            return [str(path) for path in paths]
+    raise ValueError(f'{type(dataset).__name__} has no image path list')
+
+
+def has_random_flip(transform):
+    return any(isinstance(t, transforms.RandomHorizontalFlip) for t in getattr(transform, 'transforms', []))
+
+
+def get_dataframe_digest(df):
+    """Content hash of a pandas DataFrame (index, columns and values)."""
+    import pandas as pd
+    sha = hashlib.sha1(json.dumps(list(map(str, df.columns))).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return sha.hexdigest()
+
+
+def cached_index(cache_dir, name, config, build):
+    """Return build() (a json-serializable dict), stored under `cache_dir` by the hash of `config`.
+
+    `config` has to describe every input of build(), e.g. a DataFrame digest and the
+    mtime of globbed directories. With `cache_dir` None the index is always rebuilt.
+    """
+    if cache_dir is None:
+        return build()
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'{name}_index_{key}.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    index = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{path}.tmp', path)
+    return index
+
+
+class _DecodeDataset(Dataset):
+    """Decode + resize of one image to (H, W, 3) uint8; only used to fill a shard."""
+
+    def __init__(self, paths, size):
+        self.paths = paths
+        self.resize = transforms.Resize((size, size))  # same resize as the datasets' transforms
+
+    def __getitem__(self, index):
+        image = self.resize(Image.open(self.paths[index]).convert('RGB'))
+        return torch.from_numpy(np.asarray(image, dtype=np.uint8).copy())
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def build_shard(path, image_paths, size, num_workers=4, batch_size=64):
+    """Decode every image once into a (N, size, size, 3) uint8 .npy file at `path`."""
+    tmp_path = f'{path}.tmp.npy'
+    shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(image_paths), size, size, 3))
+    loader = DataLoader(_DecodeDataset(image_paths, size), batch_size=batch_size, num_workers=num_workers)
+    offset = 0
+    for images in loader:
+        shard[offset:offset + len(images)] = images.numpy()
+        offset += len(images)
+    shard.flush()
+    del shard
+    os.replace(tmp_path, path)  # a crash never leaves a partial shard under the final name
+
+
+class ShardCachedDataset(Dataset):
+    """uint8 shard of a file-based dataset, decoded and resized once.
+
+    The shard is keyed by (dataset, image_size, split, test_id) and a hash of the
+    image list, so a changed split rebuilds it. Samples are served as (3, H, W)
+    float tensors in [0, 1], exactly what Resize + ToTensor gives on the images;
+    a RandomHorizontalFlip of the original transform is kept as a tensor flip.
+    """
+
+    def __init__(self, dataset, labels, cache_dir, name, image_size, split, test_id=1, num_workers=4):
+        image_paths = get_image_paths(dataset)
+        assert len(image_paths) == len(labels)
+        self.labels = np.asarray(labels).astype(np.int64)
+        self.flip = has_random_flip(dataset.transform)
+
+        digest = hashlib.sha1('\n'.join(image_paths).encode()).hexdigest()[:16]
+        key = f'{name}_{image_size}_{split}_{test_id}_{digest}'
+        self.data_path = os.path.join(cache_dir, f'{key}.npy')
+        if not os.path.exists(self.data_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            print(f'Build shard {self.data_path} ({len(image_paths)} images)')
+            build_shard(self.data_path, image_paths, image_size, num_workers=num_workers)
+            with open(os.path.join(cache_dir, f'{key}.json'), 'w') as f:
+                json.dump({'dataset': name, 'image_size': image_size, 'split': split, 'test_id': test_id,
+                           'image_paths': image_paths}, f)
+        self.data = np.load(self.data_path, mmap_mode='r')
+        assert self.data.shape == (len(image_paths), image_size, image_size, 3)
+
+    def _load(self, indices):
+        indices = np.asarray(indices)
+        order = np.argsort(indices)  # sorted reads keep the memmap access sequential
+        x = np.empty((len(indices),) + self.data.shape[1:], dtype=np.uint8)
+        x[order] = self.data[indices[order]]
+        x = torch.from_numpy(x).permute(0, 3, 1, 2).float().div(255)
+        if self.flip:  # one draw per image, as transforms.RandomHorizontalFlip
+            flip = torch.rand(len(x)) < 0.5
+            x = torch.where(flip[:, None, None, None], x.flip(3), x)
+        return x
+
+    def __getitem__(self, index):
+        return self._load([index])[0], self.labels[index].item()
+
+    def __getitems__(self, indices):
+        # batched path of the DataLoader: one read per batch instead of one per image
+        x = self._load(indices)
+        return [(x_i, self.labels[i].item()) for x_i, i in zip(x, indices)]
+
+    def __len__(self):
+        return len(self.labels)
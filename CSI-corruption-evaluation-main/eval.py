@@ -22,8 +22,13 @@ elif P.mode in ['ood', 'ood_pre']:
     
     for param in model.parameters():
             param.requires_grad = True
-    auroc_dict = eval_ood_detection(P, model, test_loader, ood_test_loader, P.ood_score,
-                                    train_loader=train_loader, simclr_aug=simclr_aug)
+    if single_pass:
+        from evals.ood_pre import eval_one_class_detection
+        auroc_dict = eval_one_class_detection(P, model, full_test_loader, full_test_labels, cls_list, P.ood_score,
+                                              train_loader=train_loader, simclr_aug=simclr_aug)
+    else:
+        auroc_dict = eval_ood_detection(P, model, test_loader, ood_test_loader, P.ood_score,
+                                        train_loader=train_loader, simclr_aug=simclr_aug)
         # {'one_class_1': {'CSI': 0.728107},
         #  'one_class_2': {'CSI': 0.9557279999999999},
         #  'one_class_3': {'CSI': 0.9823710000000001},
@@ -1,10 +1,12 @@
+import os
+import json
 import time
-import logging
+import bisect
 from collections import OrderedDict
-from collections.abc import Iterable
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, Dataset, TensorDataset
 
 
 def wrapper_method(func):
@@ -17,6 +19,109 @@ def wrapper_method(func):
     return wrapper_func
 
 
+class AdversarialShardWriter(object):
+    r"""
+    Append-only store of adversarial examples.
+    Every appended batch becomes one raw shard per key (`<key>_<n>.bin`), and
+    `index.json` records the dtype and shape of each shard. Writing a batch
+    costs only that batch, and the index is rewritten after every shard, so an
+    interrupted run stays loadable. The shards listed by an earlier index.json
+    in `save_dir` are removed first, so they never mix with the new ones; no
+    other file is touched.
+    """
+    dtypes = {'float': np.float32, 'half': np.float16, 'int': np.uint8}
+
+    def __init__(self, save_dir, save_type='float'):
+        if save_type not in self.dtypes:
+            raise ValueError(save_type + " is not a valid type. [Options: float, half, int]")
+        if os.path.isfile(save_dir):
+            raise ValueError(save_dir + " is a file. The shard store is a directory; the single-file format of "
+                                        "earlier versions can still be read by Attack.load, but not written.")
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self._clear()
+        self.index = {'save_type': save_type, 'shards': []}
+        self._write_index()
+
+    def _clear(self):
+        index_path = os.path.join(self.save_dir, 'index.json')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as f:
+            shards = json.load(f)['shards']
+        os.remove(index_path)  # first, so a store is never indexed with missing shards
+        for shard in shards:
+            for meta in shard.values():
+                path = os.path.join(self.save_dir, os.path.basename(meta['file']))
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def append(self, batch):
+        shard = dict()
+        for key, tensor in batch.items():
+            array = tensor.numpy()
+            file_name = '%s_%05d.bin' % (key, len(self.index['shards']))
+            array.tofile(os.path.join(self.save_dir, file_name))
+            shard[key] = {'file': file_name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        self.index['shards'].append(shard)
+        self._write_index()
+
+    def _write_index(self):
+        path = os.path.join(self.save_dir, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+
+class AdversarialShardDataset(Dataset):
+    r"""
+    Lazy dataset over a store written by AdversarialShardWriter.
+    Shards are memory-mapped, so only the samples that are read are paged in.
+    """
+
+    def __init__(self, load_dir, keys=('adv_inputs', 'labels'), normalize=None):
+        with open(os.path.join(load_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        self.load_dir = load_dir
+        self.keys = list(keys)
+        self.save_type = self.index['save_type']
+        self._maps = dict()
+
+        sizes = [shard['labels']['shape'][0] for shard in self.index['shards']]
+        self.offsets = np.cumsum([0] + sizes).tolist()
+
+        self.mean, self.std = None, None
+        if normalize is not None:
+            n_channels = len(normalize['mean'])
+            self.mean = torch.tensor(normalize['mean']).reshape(n_channels, 1, 1)
+            self.std = torch.tensor(normalize['std']).reshape(n_channels, 1, 1)
+
+    def _get_map(self, shard_idx, key):
+        # opened on first use so that every DataLoader worker holds its own maps
+        if (shard_idx, key) not in self._maps:
+            meta = self.index['shards'][shard_idx][key]
+            self._maps[(shard_idx, key)] = np.memmap(os.path.join(self.load_dir, meta['file']), mode='r',
+                                                     dtype=np.dtype(meta['dtype']), shape=tuple(meta['shape']))
+        return self._maps[(shard_idx, key)]
+
+    def __getitem__(self, index):
+        shard_idx = bisect.bisect_right(self.offsets, index) - 1
+        local_idx = index - self.offsets[shard_idx]
+
+        items = []
+        for key in self.keys:
+            item = torch.from_numpy(np.array(self._get_map(shard_idx, key)[local_idx]))
+            if key in ['adv_inputs', 'clean_inputs']:
+                item = item.float() / 255 if self.save_type == 'int' else item.float()
+                if self.mean is not None:
+                    item = (item - self.mean) / self.std
+            items.append(item)
+        return tuple(items)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+
 class Attack(object):
     r"""
     Base class for all attacks.
@@ -209,24 +314,22 @@ class Attack(object):
             self.model.train()
 
     def save(self, data_loader, save_path=None, verbose=True, return_verbose=False,
-             save_predictions=False, save_clean_inputs=False, save_type='float'):
+             save_predictions=False, save_clean_inputs=False, save_type='float', is_normal=False):
         r"""
-        Save adversarial inputs as torch.tensor from given torch.utils.data.DataLoader.
+        Save adversarial inputs from given torch.utils.data.DataLoader.
+        Every batch is appended to `save_path` as raw shards (see AdversarialShardWriter).
         Arguments:
-            save_path (str): save_path.
+            save_path (str): directory of the shard store.
             data_loader (torch.utils.data.DataLoader): data loader.
             verbose (bool): True for displaying detailed information. (Default: True)
             return_verbose (bool): True for returning detailed information. (Default: False)
             save_predictions (bool): True for saving predicted labels (Default: False)
             save_clean_inputs (bool): True for saving clean inputs (Default: False)
+            save_type (str): storage type of inputs. [Options: float, half, int] (Default: float)
+            is_normal (bool): attack the inputs as in-distribution samples (Default: False)
         """
         if save_path is not None:
-            adv_input_list = []
-            label_list = []
-            if save_predictions:
-                pred_list = []
-            if save_clean_inputs:
-                input_list = []
+            writer = AdversarialShardWriter(save_path, save_type=save_type)
 
         correct = 0
         total = 0
@@ -237,7 +340,7 @@ class Attack(object):
 
         for step, (inputs, labels) in enumerate(data_loader):
             start = time.time()
-            adv_inputs = self.__call__(inputs, labels)
+            adv_inputs = self.__call__(inputs, is_normal=is_normal)
             batch_size = len(inputs)
 
             if verbose or return_verbose:
@@ -265,36 +368,23 @@ class Attack(object):
                         self._save_print(progress, rob_acc, l2, elapsed_time, end='\r')
 
             if save_path is not None:
-                adv_input_list.append(adv_inputs.detach().cpu())
-                label_list.append(labels.detach().cpu())
-
-                adv_input_list_cat = torch.cat(adv_input_list, 0)
-                label_list_cat = torch.cat(label_list, 0)
-
-                save_dict = {'adv_inputs': adv_input_list_cat, 'labels': label_list_cat}
-
+                batch = {'adv_inputs': adv_inputs.detach().cpu(), 'labels': labels.detach().cpu()}
                 if save_predictions:
-                    pred_list.append(pred.detach().cpu())
-                    pred_list_cat = torch.cat(pred_list, 0)
-                    save_dict['preds'] = pred_list_cat
-
+                    batch['preds'] = pred.detach().cpu()
                 if save_clean_inputs:
-                    input_list.append(inputs.detach().cpu())
-                    input_list_cat = torch.cat(input_list, 0)
-                    save_dict['clean_inputs'] = input_list_cat
+                    batch['clean_inputs'] = inputs.detach().cpu()
 
-                if self.normalization_used is not None:
-                    save_dict['adv_inputs'] = self.inverse_normalize(save_dict['adv_inputs'])
-                    if save_clean_inputs:
-                        save_dict['clean_inputs'] = self.inverse_normalize(save_dict['clean_inputs'])
+                for key in ['adv_inputs', 'clean_inputs']:
+                    if key not in batch:
+                        continue
+                    if self.normalization_used is not None:
+                        batch[key] = self.inverse_normalize(batch[key])
+                    if save_type == 'int':
+                        batch[key] = self.to_type(batch[key], 'int')
+                    elif save_type == 'half':
+                        batch[key] = batch[key].half()
 
-                if save_type == 'int':
-                    save_dict['adv_inputs'] = self.to_type(save_dict['adv_inputs'], 'int')
-                    if save_clean_inputs:
-                        save_dict['clean_inputs'] = self.to_type(save_dict['clean_inputs'], 'int')
-
-                save_dict['save_type'] = save_type
-                torch.save(save_dict, save_path)
+                writer.append(batch)
 
         # To avoid erasing the printed information.
         if verbose:
@@ -328,8 +418,7 @@ class Attack(object):
 
     @staticmethod
     def load(load_path, batch_size=128, shuffle=False, normalize=None,
-             load_predictions=False, load_clean_inputs=False):
-        save_dict = torch.load(load_path)
+             load_predictions=False, load_clean_inputs=False, num_workers=0):
         keys = ['adv_inputs', 'labels']
 
         if load_predictions:
@@ -337,6 +426,15 @@ class Attack(object):
         if load_clean_inputs:
             keys.append('clean_inputs')
 
+        if os.path.isdir(load_path):  # shard store written by save()
+            adv_data = AdversarialShardDataset(load_path, keys=keys, normalize=normalize)
+            adv_loader = DataLoader(adv_data, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+            print("Data is loaded in the following order: [%s]" % (", ".join(keys)))
+            return adv_loader
+
+        # single-file format of earlier versions
+        save_dict = torch.load(load_path)
+
         if save_dict['save_type'] == 'int':
             save_dict['adv_inputs'] = save_dict['adv_inputs'].float() / 255
             if load_clean_inputs:
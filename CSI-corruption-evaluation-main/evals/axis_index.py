@@ -0,0 +1,189 @@
+import time
+
+import torch
+
+
+def max_similarity(query, bank, chunk_size=4096):
+    """Row-wise maximum of query @ bank.t(), computed tile by tile.
+
+    query: (N, d), bank: (M, d) -> (N,)
+    Only a (chunk_size, chunk_size) block of similarities is alive at a time,
+    and no value leaves the device, so the whole call has no host sync.
+    """
+    row_max = []
+    for i in range(0, query.size(0), chunk_size):
+        q = query[i:i + chunk_size]
+        running = None
+        for j in range(0, bank.size(0), chunk_size):
+            tile_max = torch.mm(q, bank[j:j + chunk_size].t()).max(dim=1)[0]  # (n)
+            running = tile_max if running is None else torch.maximum(running, tile_max)
+        row_max.append(running)
+    return torch.cat(row_max)
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0):
+    """Lloyd's k-means on the rows of x (M, d). Returns centroids (k, d) and assignments (M)."""
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    init = torch.randperm(x.size(0), generator=generator)[:n_clusters].to(x.device)
+    centroids = x[init].clone()
+
+    for _ in range(n_iter):
+        # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+        assign = (x @ centroids.t() - 0.5 * (centroids ** 2).sum(dim=1)).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters).unsqueeze(1).to(x.dtype)
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)  # keep empty clusters
+
+    assign = (x @ centroids.t() - 0.5 * (centroids ** 2).sum(dim=1)).argmax(dim=1)
+    return centroids, assign
+
+
+class ExactIndex(object):
+    """Brute-force max inner product over the whole bank."""
+    name = 'exact'
+
+    def __init__(self, bank, chunk_size=4096):
+        self.bank = bank
+        self.chunk_size = chunk_size
+
+    def max_similarity(self, query):
+        return max_similarity(query, self.bank, self.chunk_size)
+
+    def search(self, query):
+        values, indices = [], []
+        for i in range(0, query.size(0), self.chunk_size):
+            q = query[i:i + self.chunk_size]
+            best, best_idx = None, None
+            for j in range(0, self.bank.size(0), self.chunk_size):
+                tile, tile_idx = torch.mm(q, self.bank[j:j + self.chunk_size].t()).max(dim=1)
+                if best is None:
+                    best, best_idx = tile, tile_idx + j
+                else:
+                    better = tile > best
+                    best = torch.where(better, tile, best)
+                    best_idx = torch.where(better, tile_idx + j, best_idx)
+            values.append(best)
+            indices.append(best_idx)
+        return torch.cat(values), torch.cat(indices)
+
+
+class IVFIndex(object):
+    """Inverted-file index: the bank is clustered with k-means and a query only
+    visits the rows of its `n_probe` closest clusters."""
+    name = 'ivf'
+
+    def __init__(self, bank, n_lists=64, n_probe=8, n_iter=20, seed=0):
+        self.n_lists = min(n_lists, bank.size(0))
+        self.n_probe = min(n_probe, self.n_lists)
+        self.centroids, assign = kmeans(bank, self.n_lists, n_iter=n_iter, seed=seed)
+
+        order = assign.argsort()
+        self.bank = bank[order]  # rows grouped by list
+        self.ids = order
+        counts = torch.bincount(assign, minlength=self.n_lists)
+        self.offsets = [0] + torch.cumsum(counts, dim=0).tolist()
+
+    def max_similarity(self, query):
+        return self.search(query)[0]
+
+    def search(self, query):
+        N = query.size(0)
+        coarse = query @ self.centroids.t() - 0.5 * (self.centroids ** 2).sum(dim=1)
+        probe = coarse.topk(self.n_probe, dim=1)[1]  # (N, n_probe)
+
+        # group the (query, list) pairs by list once: a single host sync for the group sizes
+        probe = probe.flatten()
+        order = probe.argsort()
+        queries = torch.arange(N, device=query.device).repeat_interleave(self.n_probe)[order]
+        groups = queries.split(torch.bincount(probe, minlength=self.n_lists).tolist())
+
+        values = query.new_full((N,), -float('inf'))
+        indices = torch.zeros(N, dtype=torch.long, device=query.device)
+        for l, q_idx in enumerate(groups):
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end or q_idx.numel() == 0:
+                continue
+            tile, tile_idx = (query[q_idx] @ self.bank[start:end].t()).max(dim=1)
+            better = tile > values[q_idx]
+            values[q_idx] = torch.where(better, tile, values[q_idx])
+            indices[q_idx] = torch.where(better, self.ids[start + tile_idx], indices[q_idx])
+        return values, indices
+
+
+class PQIndex(object):
+    """Product quantization: each of `n_subspaces` slices of a bank row is replaced
+    by one of 256 codewords, and query-codeword inner products are looked up per
+    slice. The `n_rerank` best approximate candidates are re-scored exactly."""
+    name = 'pq'
+
+    def __init__(self, bank, n_subspaces=16, n_codes=256, n_rerank=32, n_iter=20, seed=0, chunk_size=64):
+        M, d = bank.size()
+        assert d % n_subspaces == 0
+        self.bank = bank
+        self.n_subspaces = n_subspaces
+        self.sub_dim = d // n_subspaces
+        self.n_rerank = min(n_rerank, M)
+        self.chunk_size = chunk_size
+
+        n_codes = min(n_codes, M)
+        codebooks, codes = [], []
+        for j, sub in enumerate(bank.split(self.sub_dim, dim=1)):
+            centroids, assign = kmeans(sub.contiguous(), n_codes, n_iter=n_iter, seed=seed + j)
+            codebooks.append(centroids)
+            codes.append(assign)
+        self.codebooks = torch.stack(codebooks)  # (m, ks, d')
+        self.codes_t = torch.stack(codes)  # (m, M)
+
+    def max_similarity(self, query):
+        return self.search(query)[0]
+
+    def search(self, query):
+        values, indices = [], []
+        for i in range(0, query.size(0), self.chunk_size):
+            q = query[i:i + self.chunk_size]
+            q_sub = q.view(q.size(0), self.n_subspaces, self.sub_dim)
+            lut = torch.einsum('nmd,mkd->nmk', q_sub, self.codebooks)  # (n, m, ks)
+
+            index = self.codes_t.unsqueeze(0).expand(q.size(0), -1, -1)  # (n, m, M)
+            approx = lut.gather(2, index).sum(dim=1)  # (n, M)
+            candidates = approx.topk(self.n_rerank, dim=1)[1]  # (n, r)
+
+            exact = torch.einsum('nd,nrd->nr', q, self.bank[candidates])
+            best, best_pos = exact.max(dim=1)
+            values.append(best)
+            indices.append(candidates.gather(1, best_pos.unsqueeze(1)).squeeze(1))
+        return torch.cat(values), torch.cat(indices)
+
+
+def get_axis_index(P, bank):
+    if P.axis_index_type == 'exact':
+        return ExactIndex(bank, chunk_size=P.score_chunk_size)
+    elif P.axis_index_type == 'ivf':
+        return IVFIndex(bank, n_lists=P.ivf_lists, n_probe=P.ivf_probe)
+    elif P.axis_index_type == 'pq':
+        return PQIndex(bank, n_subspaces=P.pq_subspaces, n_rerank=P.pq_rerank)
+    else:
+        raise NotImplementedError()
+
+
+def _timed_search(index, query):
+    if query.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    values, indices = index.search(query)
+    if query.is_cuda:
+        torch.cuda.synchronize()
+    return values, indices, time.time() - start
+
+
+def report_axis_index(index, exact, query):
+    """Print recall@1 of `index` against brute force and the search speedup on `query` (N, d)."""
+    exact_values, exact_indices, exact_time = _timed_search(exact, query)
+    values, indices, index_time = _timed_search(index, query)
+
+    recall = (indices == exact_indices).float().mean().item()
+    error = (exact_values - values).abs()
+    print(f'[{index.name} index] recall@1 {recall:.4f}  '
+          f'|sim error| mean {error.mean().item():.5f} max {error.max().item():.5f}  '
+          f'time {index_time:.4f}s vs {exact_time:.4f}s exact (speedup {exact_time / max(index_time, 1e-12):.2f}x)')
+    return recall, exact_time / max(index_time, 1e-12)
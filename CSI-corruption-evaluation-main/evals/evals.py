@@ -11,7 +11,8 @@ from sklearn.metrics import roc_auc_score
 
 import models.transform_layers as TL
 from utils.temperature_scaling import _ECELoss
-from utils.utils import AverageMeter, set_random_seed, normalize
+from evals.loader_stream import interleave_loaders, drop_empty_loaders
+from utils.utils import AverageMeter, get_generator, normalize
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 ece_criterion = _ECELoss().to(device)
@@ -83,6 +84,8 @@ def test_classifier(P, model, loader, steps, marginal=False, logger=None):
 
 
 def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loader=None, simclr_aug=None):
+    assert len(id_loader.dataset) > 0
+    ood_loaders = drop_empty_loaders(ood_loaders)
     auroc_dict = dict()
     for ood in ood_loaders.keys():
         auroc_dict[ood] = dict()
@@ -95,7 +98,12 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
         if P.one_class_idx is not None:
             save_path += f'_{P.one_class_idx}'
 
-        scores_id = get_scores(id_loader, score_func)
+        # the ID and OOD loaders are read as one interleaved stream; 'interp' has no loader of its own
+        loaders = {None: id_loader}
+        loaders.update({ood: ood_loader for ood, ood_loader in ood_loaders.items() if ood != 'interp'})
+        stream = interleave_loaders(loaders, prefetch=P.loader_prefetch, max_active=P.loader_max_active)
+        scores = get_stream_scores(stream, score_func)
+        scores_id = scores[None]
 
         if P.save_score:
             np.save(f'{save_path}.npy', scores_id)
@@ -105,7 +113,7 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
                 scores_ood = get_scores_interp(id_loader, score_func)
                 auroc_dict['interp'][ood_score] = get_auroc(scores_id, scores_ood)
             else:
-                scores_ood = get_scores(ood_loader, score_func)
+                scores_ood = scores[ood]
                 auroc_dict[ood][ood_score] = get_auroc(scores_id, scores_ood)
 
             if P.save_score:
@@ -130,6 +138,17 @@ def get_scores(loader, score_func):
     return np.concatenate(scores)
 
 
+def get_stream_scores(stream, score_func):
+    """Scores of a stream of (source, batch) pairs, concatenated per source."""
+    scores = dict()
+    for name, (x, _) in stream:
+        s = score_func(x.to(device))
+        assert s.dim() == 1 and s.size(0) == x.size(0)
+
+        scores.setdefault(name, []).append(s.detach().cpu().numpy())
+    return {name: np.concatenate(s) for name, s in scores.items()}
+
+
 def get_scores_interp(loader, score_func):
     scores = []
     for i, (x, _) in enumerate(loader):
@@ -193,8 +212,7 @@ def get_features(model, simclr_aug, x, layer='simclr', sample_num=1):
 
     feats = []
     for seed in range(sample_num):
-        set_random_seed(seed)
-        x_t = simclr_aug(x)
+        x_t = simclr_aug(x, generator=get_generator(x.device, seed))
         with torch.no_grad():
             _, output_aux = model(x_t, penultimate=True, simclr=True, shift=True)
         feats.append(output_aux[layer])
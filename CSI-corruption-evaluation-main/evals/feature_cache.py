@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+def get_model_digest(model):
+    """Hash of the model weights, computed on every call: a model object may get other
+    weights, and the id() of a freed model is reused by the next one."""
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_sample_digest(dataset):
+    """Hash of the per-sample lists a dataset holds (file paths, targets / labels), None without any."""
+    sha = hashlib.sha1()
+    found = False
+    for attr in ['samples', 'image_files', 'image_paths', 'test_path', 'targets', 'labels']:
+        samples = getattr(dataset, attr, None)
+        if samples is None:
+            continue
+        if torch.is_tensor(samples):
+            samples = samples.numpy()
+        sha.update(attr.encode())
+        if isinstance(samples, np.ndarray):
+            sha.update(np.ascontiguousarray(samples).tobytes())
+        else:
+            sha.update(json.dumps(list(samples), default=str).encode())
+        found = True
+    return sha.hexdigest() if found else None
+
+
+def get_dataset_fingerprint(dataset):
+    """Describe which samples a dataset serves, following Subset chains down to the base set."""
+    fingerprint = []
+    while isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        fingerprint.append(hashlib.sha1(indices.tobytes()).hexdigest())
+        dataset = dataset.dataset
+
+    fingerprint += [type(dataset).__name__, len(dataset)]
+    for attr in ['root', 'data_path', 'severity']:
+        if isinstance(getattr(dataset, attr, None), (str, list)):
+            fingerprint.append(getattr(dataset, attr))
+    digest = get_sample_digest(dataset)  # e.g. another split of the same files or another brain split seed
+    if digest is not None:
+        fingerprint.append(digest)
+    return fingerprint
+
+
+def get_feature_key(P, model, data_name, loader, layers, sample_num, fingerprint=None):
+    """(sha1 key, config) of the features of `loader`; `fingerprint` replaces the
+    get_dataset_fingerprint of loader.dataset, e.g. for a tensorized copy of a dataset."""
+    config = {
+        'model': get_model_digest(model),
+        'data_name': data_name,
+        'test_id': P.test_id,  # DiagViB / Waterbirds / ... pick their test split from it
+        'dataset': get_dataset_fingerprint(loader.dataset) if fingerprint is None else fingerprint,
+        'layers': sorted(layers),
+        'ood_samples': sample_num,
+        'resize_factor': P.resize_factor,
+        'resize_fix': P.resize_fix,
+        'shift_trans_type': P.shift_trans_type,
+        'K_shift': P.K_shift,
+        'image_size': P.image_size,
+        'view_keys': 'dataset_index',  # views are drawn per (sample, view), see _get_view_blocks
+    }
+    if not data_name.endswith('_train'):  # test transforms may add synthetic noise
+        config['noise'] = [P.noise_mean, P.noise_std, P.noise_scale]
+    if P.batched_crops:  # grid_sample views of an antialiased downscale instead of PIL crops
+        config['batched_crops'] = 'antialias'
+    if getattr(loader, 'corruption', None) is not None:  # CorruptedLoader
+        # noise is drawn per batch, so the batch size decides which noise a sample gets
+        config['corruption'] = [type(loader.corruption).__name__, loader.corruption.severity, loader.seed,
+                                loader.batch_size, loader.classes]
+
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+    return key, config
+
+
+def load_features(P, key, layers):
+    """Memory-map every cached layer of `key`; layers missing on disk are left out."""
+    feats_dict = dict()
+    for layer in layers:
+        path = os.path.join(P.feature_cache_dir, key, f'{layer}.npy')
+        if os.path.exists(path):
+            # copy-on-write map: pages are read lazily and the tensor stays writable
+            feats_dict[layer] = torch.from_numpy(np.load(path, mmap_mode='c'))
+    return feats_dict
+
+
+def save_features(P, key, config, feats_dict):
+    cache_dir = os.path.join(P.feature_cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with open(os.path.join(cache_dir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+    for layer, feats in feats_dict.items():
+        path = os.path.join(cache_dir, f'{layer}.npy')
+        with open(path + '.tmp', 'wb') as f:  # rename at the end so readers never see a partial file
+            np.save(f, feats.numpy())
+        os.replace(path + '.tmp', path)
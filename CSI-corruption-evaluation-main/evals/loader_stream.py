@@ -0,0 +1,67 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def drop_empty_loaders(loaders):
+    """`loaders` without the ones over an empty dataset, which would never yield a batch."""
+    for name, loader in loaders.items():
+        if loader is not None and len(loader.dataset) == 0:
+            print(f'Skip {name}: empty dataset')
+    return {name: loader for name, loader in loaders.items() if loader is None or len(loader.dataset) > 0}
+
+
+def interleave_loaders(loaders, prefetch=8, max_active=2):
+    """Yield (name, batch) from every loader of the `loaders` dict, round-robin, as one stream.
+
+    A background thread keeps up to `prefetch` batches queued, so the consumer rarely waits
+    for a loader. At most `max_active` iterators (and so their DataLoader workers) are open
+    at once; the next loader starts when one is exhausted. Batches of each loader arrive in
+    their original order. An error in a loader is re-raised in the consumer.
+    """
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        pending = list(loaders.items())
+        iterators = []
+        try:
+            while (pending or iterators) and not stop.is_set():
+                while pending and len(iterators) < max(max_active, 1):
+                    name, loader = pending.pop(0)
+                    iterators.append((name, iter(loader)))
+                for name, iterator in list(iterators):
+                    try:
+                        batch = next(iterator)
+                    except StopIteration:
+                        iterators.remove((name, iterator))  # drops the iterator, its workers shut down
+                        continue
+                    put((name, batch))
+        except BaseException as e:  # re-raised in the consumer
+            put(e)
+        finally:
+            iterators.clear()
+            put(_DONE)  # the consumer never blocks on a dead producer
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()  # also stops the producer when the consumer leaves early
+        thread.join()
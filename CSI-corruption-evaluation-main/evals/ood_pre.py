@@ -6,17 +6,24 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from torch.utils.data import Subset
 
 import models.transform_layers as TL
-from utils.utils import set_random_seed, normalize, get_auroc
+from utils.utils import normalize, get_auroc
 # from evals.evals import get_auroc
 
+from evals.axis_index import ExactIndex, get_axis_index, max_similarity, report_axis_index
+from evals.feature_cache import get_feature_key, load_features, save_features
+from evals.loader_stream import interleave_loaders, drop_empty_loaders
 from evals.pgd import PGD
 from evals.fgsm import FGSM
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 hflip = TL.HorizontalFlipLayer().to(device)
 
+CPU_ACTIVATION_FACTOR = 128  # rough activation-to-input memory ratio of a ResNet forward
+_chunk_sizes = dict()  # forward chunk size per input shape
+
 
 def make_model_gradient(model, action):
     for param in model.parameters():
@@ -32,103 +39,43 @@ class DifferentiableScoreModel(nn.Module):
         self.device = device
         self.model = model
         self.simclr_aug = simclr_aug
+        self.index = None  # dataset indices (B) of the attacked batch, select its view streams
+
+        # train-side statistics are constant during the attack, keep them on device once
+        self.register_buffer('axis', torch.stack([axis.to(device) for axis in P.axis]))  # (K, M, d)
+        self.register_buffer('weight_sim', torch.tensor(P.weight_sim, dtype=torch.float, device=device))  # (K)
+        self.register_buffer('weight_shi', torch.tensor(P.weight_shi, dtype=torch.float, device=device))  # (K)
 
     def get_scores(self, feats_dict, x):
         P = self.P
-        device = self.device
-        # convert to gpu tensor
-        feats_sim = feats_dict['simclr'].to(device)
-        feats_shi = feats_dict['shift'].to(device)
-        N = feats_sim.size(0)
-
-        # compute scores
-        scores = []
-        for f_sim, f_shi in zip(feats_sim, feats_shi):
-            f_sim = [f.mean(dim=0, keepdim=True).requires_grad_() for f in f_sim.chunk(P.K_shift)]  # list of (1, d)
-            f_shi = [f.mean(dim=0, keepdim=True).requires_grad_() for f in f_shi.chunk(P.K_shift)]  # list of (1, 4)
-            score = torch.zeros(1, requires_grad=True).to(device)
-            for shi in range(P.K_shift):
-                score = score + (f_sim[shi] * P.axis[shi].to(device)).sum(dim=1).requires_grad_().max() * torch.tensor(
-                    P.weight_sim[shi], requires_grad=True).to(device)
-                score = score + (f_shi[shi][:, shi]) * torch.tensor(P.weight_shi[shi], requires_grad=True).to(device)
-
-            score = score / P.K_shift
-            scores.append(score)
-        scores = torch.stack(scores).reshape(-1)
-
-        assert scores.dim() == 1 and scores.size(0) == N  # (N)
+        max_sim = lambda shi, query: max_similarity(query, self.axis[shi], P.score_chunk_size)
+        scores = reduce_scores(P, feats_dict['simclr'], feats_dict['shift'], max_sim,
+                               self.weight_sim, self.weight_shi)
         return scores.cpu()
 
     def get_features(self, data_name, model, data_batch,
                      simclr_aug=None, sample_num=1, layers=('simclr', 'shift')):
         P = self.P
-        if not isinstance(layers, (list, tuple)):
-            layers = [layers]
-
-        # load pre-computed features if exists
-        feats_dict = dict()
-
-        # pre-compute features and save to the path
-        left = [layer for layer in layers if layer not in feats_dict.keys()]
-        if len(left) > 0:
-            _feats_dict = self._get_features(model, data_batch,
-                                             simclr_aug, sample_num, layers=left)
-
-            for layer, feats in _feats_dict.items():
-                feats_dict[layer] = feats
-
-        return feats_dict
-
-    def _get_features(self, model, data_batch, simclr_aug=None,
-                      sample_num=1, layers=('simclr', 'shift')):
-        P = self.P
-        device = self.device
         if not isinstance(layers, (list, tuple)):
             layers = [layers]
         # check if arguments are valid
         assert simclr_aug is not None
-        # compute features in full dataset
+
         model.eval()
-        feats_all = {layer: [] for layer in layers}  # initialize: empty list
-        x = data_batch.to(device)  # gpu tensor
-        # compute features in one batch
-        feats_batch = {layer: [] for layer in layers}  # initialize: empty list
-        for seed in range(sample_num):
-            set_random_seed(seed)
-            if P.K_shift > 1:
-                x_t = torch.cat([P.shift_trans(hflip(x), k) for k in range(P.K_shift)])
-            else:
-                x_t = x  # No shifting: SimCLR
-            x_t = simclr_aug(x_t)
-            kwargs = {layer: True for layer in layers}  # only forward selected layers
-            _, output_aux = model(x_t, **kwargs)
-            # add features in one batch
-            for layer in layers:
-                feats = output_aux[layer].cpu()
-                feats_batch[layer] += feats.chunk(P.K_shift)  # (B, d) cpu tensor
+        x = data_batch.to(self.device)  # gpu tensor
+        B = x.size(0)
 
-        # concatenate features in one batch
-        for key, val in feats_batch.items():
-            feats_batch[key] = torch.stack(val, dim=1)  # (B, T, d)
+        # all seeds and shifts in a single differentiable forward pass, ordered (seed, k, b)
+        x_t = torch.cat([x_v for x_v, _, _ in _get_view_blocks(P, x, simclr_aug, sample_num, index=self.index)])
+        kwargs = {layer: True for layer in layers}  # only forward selected layers
+        _, output_aux = model(x_t, **kwargs)
 
-        # add features in full dataset
+        feats_dict = dict()
         for layer in layers:
-            feats_all[layer] += [feats_batch[layer]]
-
-        # concatenate features in full dataset
-        for key, val in feats_all.items():
-            feats_all[key] = torch.cat(val, dim=0)  # (N, T, d)
-
-        # reshape order
-
-        for key, val in feats_all.items():
-            N, T, d = val.size()  # T = K * T'
-            val = val.view(N, -1, P.K_shift, d)  # (N, T', K, d)
-            val = val.transpose(2, 1)  # (N, 4, T', d)
-            val = val.reshape(N, T, d)  # (N, T, d)
-            feats_all[key] = val
-
-        return feats_all
+            feats = output_aux[layer].view(sample_num, P.K_shift, B, -1)
+            feats = feats.permute(2, 1, 0, 3).reshape(B, P.K_shift * sample_num, -1)  # (B, T, d)
+            feats_dict[layer] = feats
+        return feats_dict
 
     def forward(self, x):
         P = self.P
@@ -161,6 +108,81 @@ class DifferentiableScoreModel(nn.Module):
 
 
 def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loader=None, simclr_aug=None):
+    assert len(ood_scores) == 1  # assume single ood_score for simplicity
+    ood_score = ood_scores[0]
+
+    prepare_ood_detection(P, model, train_loader, simclr_aug=simclr_aug)
+    set_ood_score(P, model, ood_score, simclr_aug=simclr_aug)
+
+    feats_id, feats_ood = get_test_features(P, model, id_loader, ood_loaders, simclr_aug=simclr_aug)
+    return score_test_features(P, feats_id, feats_ood, ood_score)
+
+
+def eval_one_class_detection(P, model, full_test_loader, labels, cls_list, ood_scores,
+                             train_loader=None, simclr_aug=None, fingerprint=None):
+    """One-class evaluation from a single pass over the full test set.
+
+    Features and scores are computed once for every test sample; the ID samples and each
+    other superclass are then selected with masks on `labels`. Returns the same
+    {f'one_class_{c}': {score: auroc}} dict as eval_ood_detection on per-class loaders; the
+    random views are keyed by the index in the full test set, so a sample gets the same
+    views as in its per-class Subset. Adversarial inputs depend on the class of the
+    sample, so attacks are not supported. `fingerprint` identifies the test
+    set in the feature cache key (see get_feature_key).
+    """
+    assert len(ood_scores) == 1  # assume single ood_score for simplicity
+    assert not (P.in_attack or P.out_attack)
+    ood_score = ood_scores[0]
+
+    prepare_ood_detection(P, model, train_loader, simclr_aug=simclr_aug)
+    set_ood_score(P, model, ood_score, simclr_aug=simclr_aug)
+
+    print('Pre-compute features...')
+    kwargs = {
+        'simclr_aug': simclr_aug,
+        'sample_num': P.ood_samples,
+        'layers': P.ood_layer,
+    }
+    feats = get_features(P, P.dataset, model, full_test_loader, fingerprint=fingerprint, **kwargs)  # (N, T, d)
+    return score_one_class_features(P, feats, labels, cls_list, ood_score)
+
+
+def score_one_class_features(P, feats, labels, cls_list, ood_score):
+    labels = np.asarray(labels)
+    masks = [np.isin(labels, cls_list[c]) for c in range(len(cls_list))]
+
+    print(f'Compute OOD scores... (score: {ood_score})')
+    scores = get_scores(P, feats, ood_score).numpy()  # (N), every test sample scored once
+    scores_id = scores[masks[P.one_class_idx]]
+
+    auroc_dict = dict()
+    scores_ood = dict()
+    for c, mask in enumerate(masks):
+        if c == P.one_class_idx:
+            continue
+        scores_ood[f'one_class_{c}'] = scores[mask]
+        auroc_dict[f'one_class_{c}'] = {ood_score: get_auroc(scores_id, scores[mask])}
+
+    one_class_total = get_auroc(scores_id, np.concatenate(list(scores_ood.values())))
+    print(f'One_class_real_mean: {one_class_total}')
+    P.one_class_real_mean = one_class_total
+
+    if P.axis_index_report and P.axis_index_type != 'exact':
+        feats_id = {layer: f[masks[P.one_class_idx]] for layer, f in feats.items()}
+        feats_ood = {f'one_class_{c}': {layer: f[mask] for layer, f in feats.items()}
+                     for c, mask in enumerate(masks) if c != P.one_class_idx}
+        report_index_tradeoff(P, feats_id, feats_ood, auroc_dict, ood_score)
+
+    if P.print_score:
+        print_score(P.dataset, scores_id)
+        for ood, scores in scores_ood.items():
+            print_score(ood, scores)
+
+    return auroc_dict
+
+
+def prepare_ood_detection(P, model, train_loader, simclr_aug=None):
+    """Train-side statistics shared by every test set: P.axis, P.axis_index and the CSI weights."""
     P.K_shift = 1
     P.PGD_constant = 2.5
     P.alpha = (P.PGD_constant * P.eps) / P.steps
@@ -177,14 +199,6 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
         if P.desired_attack == 'PGD':
             print("Steps:", P.steps)
 
-
-    auroc_dict = dict()
-    for ood in ood_loaders.keys():
-        auroc_dict[ood] = dict()
-
-    assert len(ood_scores) == 1  # assume single ood_score for simplicity
-    ood_score = ood_scores[0]
-
     kwargs = {
         'simclr_aug': simclr_aug,
         'sample_num': P.ood_samples,
@@ -203,6 +217,7 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
         P.axis.append(normalize(axis, dim=1).to(device))
     # P.axis: [torch.Size([5000, 128]), torch.Size([5000, 128]), torch.Size([5000, 128]), torch.Size([5000, 128])]
     print('axis size: ' + ' '.join(map(lambda x: str(len(x)), P.axis)))
+    P.axis_index = [get_axis_index(P, axis) for axis in P.axis]
 
     # f_shi: [torch.Size([5000, 128]), torch.Size([5000, 128]), torch.Size([5000, 128]), torch.Size([5000, 128])]
     f_sim = [f.mean(dim=1) for f in feats_train['simclr'].chunk(P.K_shift, dim=1)]  # list of (M, d)
@@ -221,13 +236,19 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
         weight_shi.append(1 / shi_mean.mean().item())
     # weight_shi= (4,)
     # weight_shi= (4,)
+    P.csi_weight_sim = weight_sim
+    P.csi_weight_shi = weight_shi
+
+
+def set_ood_score(P, model, ood_score, simclr_aug=None):
+    """Select the score weights and build the attack against that score."""
     # ood_score == 'CSI'
     if ood_score == 'simclr':
         P.weight_sim = [1]
         P.weight_shi = [0]
     elif ood_score == 'CSI':
-        P.weight_sim = weight_sim
-        P.weight_shi = weight_shi
+        P.weight_sim = P.csi_weight_sim
+        P.weight_shi = P.csi_weight_shi
     else:
         raise ValueError()
 
@@ -235,22 +256,63 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
     print(f'weight_shi:\t' + '\t'.join(map('{:.4f}'.format, P.weight_shi)))
     
     ## Preprocessing is Ended
-    P, device, model, simclr_aug
     score_model = DifferentiableScoreModel(P, device, model, simclr_aug)
     P.attack = {'PGD': PGD(score_model, steps=P.steps, eps=P.eps, alpha=P.alpha),
                 'FGSM': FGSM(score_model, eps=P.eps)
                 }[P.desired_attack]
 
+
+def get_test_features(P, model, id_loader, ood_loaders, simclr_aug=None):
+    """Features of the ID loader and every OOD loader.
+
+    Sources not in the feature cache are read as one interleaved, prefetched stream
+    (see interleave_loaders), so the active loaders' workers decode while the model runs.
+    """
+    layers = P.ood_layer if isinstance(P.ood_layer, (list, tuple)) else [P.ood_layer]
+    assert len(id_loader.dataset) > 0
+    ood_loaders = drop_empty_loaders(ood_loaders)
+    names = {P.dataset: id_loader}  # data_name -> loader, in the order of the returned dicts
+    names.update(ood_loaders)
+    sources = {P.dataset: {'attack': P.in_attack, 'is_ood': False}}
+    sources.update({ood: {'attack': P.out_attack, 'is_ood': True} for ood in ood_loaders.keys()})
+
     print('Pre-compute features...')
-    # feats_id["shift"].shape = torch.Size([1000, 40, 4])
-    # feats_id["simclr"] = torch.Size([1000, 40, 128])
-    feats_id = get_features(P, P.dataset, model, id_loader, attack=P.in_attack, is_ood=False, **kwargs)  # (N, T, d)
-    feats_ood = dict()
-    # ood_loaders.items() = [1,2,3,4,5,6,7,8,9]
-    for ood, ood_loader in ood_loaders.items():
-        # feats_ood[ood]["shift"]: torch.Size([1000, 40, 4])
-        # feats_ood[ood]["simclr"]: torch.Size([1000, 40, 128])
-        feats_ood[ood] = get_features(P, ood, model, ood_loader, attack=P.out_attack, is_ood=True, **kwargs)
+    feats = {name: dict() for name in names.keys()}
+    cache_keys = dict()
+    for name, loader in names.items():
+        sources[name]['N'] = len(loader.dataset)
+        sources[name]['index'] = get_dataset_indices(loader.dataset)
+        if P.feature_cache_dir is None or sources[name]['attack']:  # adversarial inputs are never cached
+            continue
+        cache_keys[name] = get_feature_key(P, model, name, loader, layers, P.ood_samples)
+        feats[name] = load_features(P, cache_keys[name][0], layers)
+        if len(feats[name]) > 0:
+            print(f'Load cached features of {name} ({cache_keys[name][0]})')
+
+    left = {name: [layer for layer in layers if layer not in feats[name]] for name in names.keys()}
+    left = {name: left_layers for name, left_layers in left.items() if len(left_layers) > 0}
+    if len(left) > 0:
+        # forward every layer missing anywhere; the cached ones are kept
+        left_layers = [layer for layer in layers if any(layer in l for l in left.values())]
+        stream = interleave_loaders({name: names[name] for name in left.keys()},
+                                    prefetch=P.loader_prefetch, max_active=P.loader_max_active)
+        _feats = _get_stream_features(P, model, stream, {name: sources[name] for name in left.keys()},
+                                      P.dataset == 'imagenet', simclr_aug, P.ood_samples, left_layers)
+        for name, _feats_dict in _feats.items():
+            _feats_dict = {layer: _feats_dict[layer] for layer in left[name]}
+            feats[name].update(_feats_dict)
+            if name in cache_keys:
+                save_features(P, cache_keys[name][0], cache_keys[name][1], _feats_dict)
+
+    # feats_id["simclr"]: (N, T, d), feats_ood[ood]["simclr"]: (N_ood, T, d)
+    feats_id = feats.pop(P.dataset)
+    return feats_id, feats
+
+
+def score_test_features(P, feats_id, feats_ood, ood_score):
+    auroc_dict = dict()
+    for ood in feats_ood.keys():
+        auroc_dict[ood] = dict()
 
     print(f'Compute OOD scores... (score: {ood_score})')
     # scores_id.shape=(1000,)
@@ -273,6 +335,9 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
         one_class_total = get_auroc(scores_id, one_class_score)
         print(f'One_class_real_mean: {one_class_total}')
 
+    if P.axis_index_report and P.axis_index_type != 'exact':
+        report_index_tradeoff(P, feats_id, feats_ood, auroc_dict, ood_score)
+
     if P.print_score:
         print_score(P.dataset, scores_id)
         for ood, scores in scores_ood.items():
@@ -281,52 +346,74 @@ def eval_ood_detection(P, model, id_loader, ood_loaders, ood_scores, train_loade
     return auroc_dict
 
 
-def get_scores(P, feats_dict, ood_score):
-    # convert to gpu tensor
-    # feats_shi: [1000, 40, 128]
-    feats_sim = feats_dict['simclr'].to(device)
-    # feats_shi: [1000, 40, 4]
-    feats_shi = feats_dict['shift'].to(device)
-    N = feats_sim.size(0)
-
-    # compute scores
-    scores = []
-
-    # f_shi.shape: torch.Size([40, 4])
-    # f_sim.shape: torch.Size([40, 128])
-    for f_sim, f_shi in zip(feats_sim, feats_shi):
-
-        # f_sim: 4 * torch.Size([1, 128])
-        f_sim = [f.mean(dim=0, keepdim=True) for f in f_sim.chunk(P.K_shift)]  # list of (1, d)
-        # f_shi: 4 * torch.Size([1, 4])
-        f_shi = [f.mean(dim=0, keepdim=True) for f in f_shi.chunk(P.K_shift)]  # list of (1, 4)
-        score = 0
-        for shi in range(P.K_shift):
-            # (f_sim[shi].shape, P.axis[shi].shape) = ( torch.Size([1, 128]), torch.Size([5000, 128]) )
-            # (f_sim[shi] * P.axis[shi]).shape = torch.Size([5000, 128])
-            # (f_sim[shi] * P.axis[shi]).sum(dim=1) = torch.Size([5000])
-            score += (f_sim[shi] * P.axis[shi]).sum(dim=1).max().item() * P.weight_sim[shi]
-            score += f_shi[shi][:, shi].item() * P.weight_shi[shi]
-        score = score / P.K_shift
-        scores.append(score)
-    scores = torch.tensor(scores)
+def reduce_scores(P, feats_sim, feats_shi, max_sim, weight_sim, weight_shi):
+    """CSI score of every sample from its (N, T, d) features; differentiable.
+
+    max_sim(shi, query) returns the max similarity of each (N, d) query to the train axis of shift shi.
+    """
+    feats_sim = feats_sim.to(device)
+    feats_shi = feats_shi.to(device)
+    N, T, _ = feats_sim.size()
+
+    # views are grouped by shift ([1,1, 2,2, 3,3, 4,4]), so averaging over T' = T / K
+    # gives the per-shift mean feature of every sample at once
+    f_sim = feats_sim.view(N, P.K_shift, T // P.K_shift, -1).mean(dim=2)  # (N, K, d)
+    f_shi = feats_shi.view(N, P.K_shift, T // P.K_shift, -1).mean(dim=2)  # (N, K, 4)
+
+    shifts = torch.arange(P.K_shift, device=device)
+    sim = torch.stack([max_sim(shi, f_sim[:, shi]) for shi in range(P.K_shift)], dim=1)  # (N, K)
+    shi = f_shi[:, shifts, shifts]  # (N, K)
+
+    scores = (sim * weight_sim + shi * weight_shi).sum(dim=1) / P.K_shift
 
     assert scores.dim() == 1 and scores.size(0) == N  # (N)
+    return scores
+
+
+def get_scores(P, feats_dict, ood_score):
+    weight_sim = torch.tensor(P.weight_sim, dtype=torch.float, device=device)  # (K)
+    weight_shi = torch.tensor(P.weight_shi, dtype=torch.float, device=device)  # (K)
+    max_sim = lambda shi, query: P.axis_index[shi].max_similarity(query)
+
+    scores = reduce_scores(P, feats_dict['simclr'], feats_dict['shift'], max_sim, weight_sim, weight_shi)
     return scores.cpu()
 
 
-def get_features(P, data_name, model, loader,
-                 simclr_aug=None, sample_num=1, layers=('simclr', 'shift'), attack=False, is_ood=False):
+def report_index_tradeoff(P, feats_id, feats_ood, auroc_dict, ood_score):
+    """Compare the approximate axis index against brute force: recall/speedup
+    on the ID test queries and the resulting AUROC change per OOD set."""
+    approx_index = P.axis_index
+    exact_index = [ExactIndex(axis, chunk_size=P.score_chunk_size) for axis in P.axis]
+
+    feats_sim = feats_id['simclr'].to(device)
+    N, T, _ = feats_sim.size()
+    f_sim = feats_sim.view(N, P.K_shift, T // P.K_shift, -1).mean(dim=2)  # (N, K, d)
+    for shi in range(P.K_shift):
+        report_axis_index(approx_index[shi], exact_index[shi], f_sim[:, shi])
+
+    P.axis_index = exact_index
+    scores_id = get_scores(P, feats_id, ood_score).numpy()
+    for ood, feats in feats_ood.items():
+        auroc = get_auroc(scores_id, get_scores(P, feats, ood_score).numpy())
+        print(f'[{ood}] AUROC exact {auroc:.4f}  {P.axis_index_type} {auroc_dict[ood][ood_score]:.4f}  '
+              f'(diff {auroc_dict[ood][ood_score] - auroc:+.4f})')
+    P.axis_index = approx_index
+
+
+def get_features(P, data_name, model, loader, simclr_aug=None, sample_num=1,
+                 layers=('simclr', 'shift'), attack=False, is_ood=False, fingerprint=None):
 
     if not isinstance(layers, (list, tuple)):
         layers = [layers]
 
-    # load pre-computed features if exists
+    # load pre-computed features if exists (adversarial inputs are never cached)
     feats_dict = dict()
-    # for layer in layers:
-    #     path = prefix + f'_{data_name}_{layer}.pth'
-    #     if os.path.exists(path):
-    #         feats_dict[layer] = torch.load(path)
+    use_cache = P.feature_cache_dir is not None and not attack
+    if use_cache:
+        key, config = get_feature_key(P, model, data_name, loader, layers, sample_num, fingerprint)
+        feats_dict = load_features(P, key, layers)
+        if len(feats_dict) > 0:
+            print(f'Load cached features of {data_name} ({key})')
 
     # pre-compute features and save to the path
     # left= ['simclr', 'shift']
@@ -338,11 +425,102 @@ def get_features(P, data_name, model, loader,
         for layer, feats in _feats_dict.items():
             feats_dict[layer] = feats  # update value
 
+        if use_cache:
+            save_features(P, key, config, _feats_dict)
+
     return feats_dict
 
 
+def get_forward_chunk_size(P, model, x_t, layers):
+    """Number of images per forward pass that fits in the memory budget.
+
+    On GPU the activation memory per image is measured with one probe forward;
+    on CPU it is estimated from the input size. Results are cached per input shape.
+    """
+    if P.feature_chunk_size > 0:
+        return P.feature_chunk_size
+
+    shape = tuple(x_t.shape[1:])
+    if shape not in _chunk_sizes:
+        input_bytes = x_t[0].numel() * x_t.element_size()
+        if x_t.is_cuda:
+            free, _ = torch.cuda.mem_get_info()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            with torch.no_grad():
+                model(x_t, **{layer: True for layer in layers})
+            image_bytes = (torch.cuda.max_memory_allocated() - base) / x_t.size(0) + input_bytes
+        else:
+            free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+            image_bytes = input_bytes * CPU_ACTIVATION_FACTOR
+        _chunk_sizes[shape] = max(int(free * P.feature_memory_fraction / image_bytes), 1)
+        print(f'Forward chunk size for {shape}: {_chunk_sizes[shape]} images')
+    return _chunk_sizes[shape]
+
+
+def get_dataset_indices(dataset):
+    """Index of every row of dataset in the set it was split from, following Subset chains,
+    so a sample gets the same views in a class subset and in the full test set."""
+    indices = np.arange(len(dataset))
+    while isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices, dtype=np.int64)[indices]
+        dataset = dataset.dataset
+    return torch.from_numpy(indices)
+
+
+def _get_view_blocks(P, x, simclr_aug, sample_num, imagenet=False, index=None):
+    """Yield the augmented views of one batch, one block per seed, together with
+    the (row, view) slot of every image of the block in the (B, T, d) output.
+
+    The random draws of an image come from a TL.RowGenerator keyed by its dataset index
+    (index, a (B) tensor, default arange(B)) and its view (seed, shift, crop), so the views
+    of a sample do not depend on the batch size, its position in the batch, the other
+    loaders or the global RNGs."""
+    _device = x.device
+    K = P.K_shift
+    S = x.size(1) if imagenet else 1
+    index = (torch.arange(x.size(0)) if index is None else index).to(_device)
+    index = index.repeat_interleave(S)  # rows of x_v, ordered (b, s)
+    crop = torch.arange(S, device=_device).repeat(x.size(0))
+    shift = torch.arange(K, device=_device).repeat_interleave(index.size(0))
+    for seed in range(sample_num):
+        x_v = x.flatten(0, 1) if imagenet else x  # (B, S, C, H, W) crops -> (B * S, C, H, W)
+        if P.K_shift > 1:
+            x_t = torch.cat([P.shift_trans(hflip(x_v, generator=TL.RowGenerator(index, seed, 0, k, crop)), k)
+                             for k in range(P.K_shift)])
+        else:
+            x_t = x_v  # No shifting: SimCLR
+        x_t = simclr_aug(x_t, generator=TL.RowGenerator(index.repeat(K), seed, 1, shift, crop.repeat(K)))
+
+        if imagenet:  # x_t is ordered (k, b, s) over the S crops of each image, T = K * S
+            B, S = x.size(0), x.size(1)
+            rows = torch.arange(B, device=_device).repeat_interleave(S).repeat(K)
+            cols = (torch.arange(K, device=_device) * S).repeat_interleave(B * S) + \
+                torch.arange(S, device=_device).repeat(B * K)
+        else:  # x_t is ordered (k, b); view (seed, k) lands at t = k * sample_num + seed
+            B = x.size(0)
+            rows = torch.arange(B, device=_device).repeat(K)
+            cols = (torch.arange(K, device=_device) * sample_num + seed).repeat_interleave(B)
+        yield x_t, rows, cols
+
+
 def _get_features(P, model, loader, imagenet=False, simclr_aug=None,
                   sample_num=1, layers=('simclr', 'shift'), attack=False, is_ood=False):
+    stream = ((None, batch) for batch in loader)
+    sources = {None: {'N': len(loader.dataset), 'index': get_dataset_indices(loader.dataset),
+                      'attack': attack, 'is_ood': is_ood}}
+    return _get_stream_features(P, model, stream, sources, imagenet, simclr_aug, sample_num, layers)[None]
+
+
+def _get_stream_features(P, model, stream, sources, imagenet=False, simclr_aug=None,
+                         sample_num=1, layers=('simclr', 'shift')):
+    """Features of a stream of (source, batch) pairs, demultiplexed per source.
+
+    sources[name] holds the dataset size 'N', the dataset 'index' of every row (see
+    get_dataset_indices) and the 'attack' / 'is_ood' flags of that source; batches of one
+    source must arrive in dataset order, but sources may be interleaved. Views of different
+    sources share the fused forward passes.
+    """
     # layers = ['simclr', 'shift']
     if not isinstance(layers, (list, tuple)):
         layers = [layers]
@@ -350,110 +528,86 @@ def _get_features(P, model, loader, imagenet=False, simclr_aug=None,
     # check if arguments are valid
     assert simclr_aug is not None
 
-    if imagenet is True:  # assume batch_size = 1 for ImageNet
+    if imagenet is True:  # the S views of every image come from the loader
         sample_num = 1
 
     # compute features in full dataset
     model.eval()
-    feats_all = {layer: [] for layer in layers}  # initialize: empty list
-    for i, (x, _) in enumerate(loader):
+    kwargs = {layer: True for layer in layers}  # only forward selected layers
+    feats_all = dict()  # name -> (N, T, d) cpu tensors, allocated once the first outputs are known
+    offsets = {name: 0 for name in sources.keys()}
+    chunk = None  # staging buffers of one fused forward pass
+    segments = []  # (name, start, end) of the chunk rows of every source
+
+    def forward_chunk(n):
+        with torch.no_grad():
+            _, output_aux = model(chunk['x'][:n], **kwargs)
+        rows, cols = chunk['rows'][:n].cpu(), chunk['cols'][:n].cpu()
+        for name, start, end in segments:
+            for layer in layers:
+                feats_all[name][layer][rows[start:end], cols[start:end]] = output_aux[layer][start:end].cpu()
+        segments.clear()
+
+    n = 0
+    for name, (x, _) in stream:
+        source = sources[name]
+        offset = offsets[name]
         if imagenet is True:
-            x = torch.cat(x[0], dim=0)  # augmented list of x
-        if attack:
-            x = P.attack(x, is_normal=not is_ood)
+            x = x[0]  # (B, S, C, H, W) views of MultiCropTransform
+            if isinstance(x, (list, tuple)):  # MultiDataTransformList: S tensors of (B, C, H, W)
+                x = torch.stack(x, dim=1)
+        index = source['index'][offset:offset + x.size(0)]
+        if source['attack']:
+            P.attack.model.index = index  # attack the views this batch is scored on
+            if imagenet is True:
+                P.attack.model.index = index.repeat_interleave(x.size(1))
+                x = P.attack(x.flatten(0, 1), is_normal=not source['is_ood']).view(x.shape)
+            else:
+                x = P.attack(x, is_normal=not source['is_ood'])
             model.eval()
             torch.cuda.empty_cache()
             gc.collect()
         x = x.to(device)  # gpu tensor
-
-        # compute features in one batch
-        feats_batch = {layer: [] for layer in layers}  # initialize: empty list
-        # sample_num=10
-        for seed in range(sample_num):
-            set_random_seed(seed)
-
-            if P.K_shift > 1:
-                # train time call:
-                #   x   = torch.Size([128, 3, 32, 32])
-                #   x_t = torch.Size([512, 3, 32, 32])
-                # test time call:
-                #   x   = torch.Size([100, 3, 32, 32])
-                #   x_t = torch.Size([400, 3, 32, 32])
-                x_t = torch.cat([P.shift_trans(hflip(x), k) for k in range(P.K_shift)])
-            else:
-                x_t = x # No shifting: SimCLR
-            x_t = simclr_aug(x_t)
-
-            # compute augmented features
-            with torch.no_grad():
-                # layers = ['simclr', 'shift']
-                kwargs = {layer: True for layer in layers}  # only forward selected layers
-                _, output_aux = model(x_t, **kwargs)
-
-            # add features in one batch
-            for layer in layers:
-                # train time call
-                #   output_aux["shift"] torch.Size([512, 4])
-                #   output_aux["simclr"] torch.Size([512, 128])
-                # test time call
-                #   output_aux["shift"] torch.Size([400, 4])
-                #   output_aux["simclr"] torch.Size([400, 128])
-                feats = output_aux[layer].cpu()
-                # imagenet = False
-                if imagenet is False:
-                    # feats.chunk(P.K_shift):
-                    #   Train:   4 * torch.Size([128, 128])   ||   4 * torch.Size([128, 4])
-                    #   Test:    4 * torch.Size([100, 128])   ||   4 * torch.Size([100, 4])
-
-                    # feats_batch[layer] = array of len=4
-                    # train:    40 * torch.Size([128, 128])  ||  40 * torch.Size([128, 4])
-                    # test:     40 * torch.Size([100, 128])  ||  40 * torch.Size([100, 4])
-                    feats_batch[layer] += feats.chunk(P.K_shift)
+        B = x.size(0)
+
+        # stack the views of all seeds and shifts into as few forward passes as memory allows
+        for x_t, rows, cols in _get_view_blocks(P, x, simclr_aug, sample_num, imagenet, index):
+            if chunk is None or chunk['x'].shape[1:] != x_t.shape[1:] or chunk['x'].dtype != x_t.dtype:
+                if n > 0:  # another image shape: run the staged views first
+                    forward_chunk(n)
+                    n = 0
+                size = get_forward_chunk_size(P, model, x_t, layers)
+                chunk = {'x': x_t.new_empty((size,) + x_t.shape[1:]),
+                         'rows': rows.new_empty(size), 'cols': cols.new_empty(size)}
+            if name not in feats_all:
+                T = P.K_shift * (x.size(1) if imagenet else sample_num)
+                with torch.no_grad():
+                    _, output_aux = model(x_t[:1], **kwargs)
+                feats_all[name] = {layer: torch.empty(source['N'], T, output_aux[layer].size(1)) for layer in layers}
+
+            size = chunk['x'].size(0)
+            for start in range(0, x_t.size(0), size):  # a block larger than the buffer is split
+                x_p = x_t[start:start + size]
+                m = x_p.size(0)
+                if n + m > size:
+                    forward_chunk(n)
+                    n = 0
+                chunk['x'][n:n + m] = x_p
+                chunk['rows'][n:n + m] = rows[start:start + size] + offset
+                chunk['cols'][n:n + m] = cols[start:start + size]
+                if segments and segments[-1][0] == name:
+                    segments[-1] = (name, segments[-1][1], n + m)
                 else:
-                    feats_batch[layer] += [feats]  # (B, d) cpu tensor
-
-        # concatenate features in one batch
-        for key, val in feats_batch.items():
-            if imagenet:
-                feats_batch[key] = torch.stack(val, dim=0)  # (B, T, d)
-            else:
-                feats_batch[key] = torch.stack(val, dim=1)  # (B, T, d)
-        # feats_batch
-        # feats_batch["simclr"] = torch.Size([128, 40, 128]) || torch.Size([100, 40, 128])
-        # feats_batch["shift"]  = torch.Size([128, 40, 4])   || torch.Size([100, 40, 4])
-
-        # add features in full dataset
-        for layer in layers:
-            feats_all[layer] += [feats_batch[layer]]
-    # feats_all["shift or simclr"] is an array len=40 --> element: [128, 40, 128]
-    #   train time call:   simclr=[40, 128, 40, 128]  || shift=[40, 128, 40, 4]
-    #   test time call:    simclr=[10, 100, 40, 128]  || shift=[10, 100, 40, 4]
-
-    # concatenate features in full dataset
-    for key, val in feats_all.items():
-        feats_all[key] = torch.cat(val, dim=0)  # (N, T, d)
-    # train time call feats_all[key]:
-    #        torch.Size([5000, 40, 128])
-    #        torch.Size([5000, 40, 4])
-    # train time call feats_all[key]:
-    #        torch.Size([1000, 40, 128])
-    #        torch.Size([1000, 40, 4])
-
-    # reshape order
-    if imagenet is False:
-        # Convert [1,2,3,4, 1,2,3,4] -> [1,1, 2,2, 3,3, 4,4]
-        for key, val in feats_all.items():
-            N, T, d = val.size()  # T = K * T'
-            val = val.view(N, -1, P.K_shift, d)  # (N, T', K, d)
-            val = val.transpose(2, 1)  # (N, 4, T', d)
-            val = val.reshape(N, T, d)  # (N, T, d)
-            feats_all[key] = val
-    # train time call feats_all[key]:
-    #        torch.Size([5000, 40, 128])
-    #        torch.Size([5000, 40, 4])
-    # train time call feats_all[key]:
-    #        torch.Size([1000, 40, 128])
-    #        torch.Size([1000, 40, 4])
+                    segments.append((name, n, n + m))
+                n += m
+        offsets[name] = offset + B
+    if n > 0:
+        forward_chunk(n)
+
+    for name, source in sources.items():
+        assert name in feats_all, f'{name} yielded no batches'  # empty sources are dropped by the callers
+        assert offsets[name] == source['N']
+    # feats_all[name][key]: (N, T, d), views ordered by shift: [1,1, 2,2, 3,3, 4,4]
     return feats_all
 
 
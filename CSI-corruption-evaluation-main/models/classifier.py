@@ -17,13 +17,18 @@ def get_simclr_augmentation(P, image_size):
     resize_crop = TL.RandomResizedCropLayer(scale=resize_scale, size=image_size)
 
     # Transform define #
+    if P.fused_augmentation:
+        if P.dataset == 'imagenet':
+            return TL.FusedSimCLRAugmentation(color_jitter, color_gray)
+        return TL.FusedSimCLRAugmentation(color_jitter, color_gray, resize_crop)
+
     if P.dataset == 'imagenet':  # Using RandomResizedCrop at PIL transform
-        transform = nn.Sequential(
+        transform = TL.AugmentationSequential(
             color_jitter,
             color_gray,
         )
     else:
-        transform = nn.Sequential(
+        transform = TL.AugmentationSequential(
             color_jitter,
             color_gray,
             resize_crop,
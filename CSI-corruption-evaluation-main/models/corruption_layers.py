@@ -0,0 +1,290 @@
+import math
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.transform_layers import rgb2hsv, hsv2rgb
+
+if torch.__version__ >= '1.4.0':
+    kwargs = {'align_corners': False}
+else:
+    kwargs = {}
+
+
+class CorruptionLayer(nn.Module):
+    """Batched corruption of (N, C, H, W) images in [0, 1] at one of five severities.
+
+    `params` holds the value of each severity; they follow the CIFAR-10-C constants
+    of Hendrycks & Dietterich [1], so severities are comparable with the .npy files.
+    Random corruptions draw from `generator` when given (must live on the input device).
+
+    References
+    [1] https://github.com/hendrycks/robustness/blob/master/ImageNet-C/create_c/make_cifar_c.py
+    """
+    params = None
+
+    def __init__(self, severity=1):
+        super(CorruptionLayer, self).__init__()
+        assert 1 <= severity <= 5
+        self.severity = severity
+        self.param = self.params[severity - 1]
+
+    def forward(self, inputs, generator=None):
+        return self.corrupt(inputs, generator).clamp(0, 1)
+
+    def corrupt(self, inputs, generator):
+        raise NotImplementedError()
+
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _depthwise_conv(inputs, kernel):
+    """Convolve every channel with a 2-d kernel (kh, kw) under reflection padding."""
+    C = inputs.size(1)
+    kh, kw = kernel.shape
+    weight = kernel.to(inputs).expand(C, 1, kh, kw)
+    padded = F.pad(inputs, (kw // 2, kw // 2, kh // 2, kh // 2), mode='reflect')
+    return F.conv2d(padded, weight, groups=C)
+
+
+def _zoom(inputs, zoom_factor):
+    """Zoom into the center by zoom_factor and keep the input size."""
+    N = inputs.size(0)
+    theta = inputs.new_tensor([[1 / zoom_factor, 0, 0], [0, 1 / zoom_factor, 0]]).repeat(N, 1, 1)
+    grid = F.affine_grid(theta, inputs.size(), **kwargs)
+    return F.grid_sample(inputs, grid, padding_mode='border', **kwargs)
+
+
+class GaussianNoiseLayer(CorruptionLayer):
+    params = [0.04, 0.06, .08, .09, .10]
+
+    def corrupt(self, inputs, generator):
+        noise = torch.randn(inputs.size(), generator=generator, device=inputs.device, dtype=inputs.dtype)
+        return inputs + noise * self.param
+
+
+class ShotNoiseLayer(CorruptionLayer):
+    params = [500, 250, 100, 75, 50]
+
+    def corrupt(self, inputs, generator):
+        return torch.poisson(inputs * self.param, generator=generator) / self.param
+
+
+class ImpulseNoiseLayer(CorruptionLayer):
+    params = [.01, .02, .03, .05, .07]
+
+    def corrupt(self, inputs, generator):
+        # salt & pepper: a fraction `param` of the values is replaced, half by 0 and half by 1
+        u = torch.rand(inputs.size(), generator=generator, device=inputs.device, dtype=inputs.dtype)
+        outputs = torch.where(u < self.param / 2, torch.zeros_like(inputs), inputs)
+        return torch.where((u >= self.param / 2) & (u < self.param), torch.ones_like(inputs), outputs)
+
+
+class SpeckleNoiseLayer(CorruptionLayer):
+    params = [.06, .1, .12, .16, .2]
+
+    def corrupt(self, inputs, generator):
+        noise = torch.randn(inputs.size(), generator=generator, device=inputs.device, dtype=inputs.dtype)
+        return inputs + inputs * noise * self.param
+
+
+class GaussianBlurLayer(CorruptionLayer):
+    params = [.4, .6, 0.7, .8, 1]
+
+    def corrupt(self, inputs, generator):
+        kernel = _gaussian_kernel(self.param)
+        outputs = _depthwise_conv(inputs, kernel.view(1, -1))
+        return _depthwise_conv(outputs, kernel.view(-1, 1))
+
+
+class DefocusBlurLayer(CorruptionLayer):
+    params = [(0.3, 0.4), (0.4, 0.5), (0.5, 0.6), (1, 0.2), (1.5, 0.1)]  # (disk radius, alias blur)
+
+    def __init__(self, severity=1):
+        super(DefocusBlurLayer, self).__init__(severity)
+        radius, alias_blur = self.param
+        L = torch.arange(-8, 8 + 1, dtype=torch.float)
+        Y, X = torch.meshgrid(L, L, indexing='ij')
+        disk = ((X ** 2 + Y ** 2) <= radius ** 2).float()
+        disk = disk / disk.sum()
+
+        # anti-alias the disk with a 3x3 gaussian (cv2.GaussianBlur(disk, (3, 3), alias_blur))
+        g = torch.exp(-0.5 * (torch.arange(-1., 2.) / alias_blur) ** 2)
+        g = g / g.sum()
+        disk = F.conv2d(F.pad(disk.view(1, 1, 17, 17), (1, 1, 1, 1), mode='reflect'), (g.view(-1, 1) * g).view(1, 1, 3, 3))
+        self.register_buffer('_kernel', disk.view(17, 17))
+
+    def corrupt(self, inputs, generator):
+        return _depthwise_conv(inputs, self._kernel)
+
+
+class ZoomBlurLayer(CorruptionLayer):
+    params = [np.arange(1, 1.06, 0.01), np.arange(1, 1.11, 0.01), np.arange(1, 1.16, 0.01),
+              np.arange(1, 1.21, 0.01), np.arange(1, 1.26, 0.01)]
+
+    def corrupt(self, inputs, generator):
+        outputs = inputs.clone()
+        for zoom_factor in self.param:
+            outputs += _zoom(inputs, float(zoom_factor))
+        return outputs / (len(self.param) + 1)
+
+
+class ContrastLayer(CorruptionLayer):
+    params = [.75, .5, .4, .3, 0.15]
+
+    def corrupt(self, inputs, generator):
+        means = inputs.mean(dim=(2, 3), keepdim=True)
+        return (inputs - means) * self.param + means
+
+
+class BrightnessLayer(CorruptionLayer):
+    params = [.05, .1, .15, .2, .3]
+
+    def corrupt(self, inputs, generator):
+        hsv = rgb2hsv(inputs)
+        hsv[:, 2] = (hsv[:, 2] + self.param).clamp(0, 1)
+        return hsv2rgb(hsv)
+
+
+class SaturateLayer(CorruptionLayer):
+    params = [(0.3, 0), (0.1, 0), (1.5, 0), (2, 0.1), (2.5, 0.2)]
+
+    def corrupt(self, inputs, generator):
+        hsv = rgb2hsv(inputs)
+        hsv[:, 1] = (hsv[:, 1] * self.param[0] + self.param[1]).clamp(0, 1)
+        return hsv2rgb(hsv)
+
+
+class PixelateLayer(CorruptionLayer):
+    params = [0.95, 0.9, 0.85, 0.75, 0.65]
+
+    def corrupt(self, inputs, generator):
+        H, W = inputs.shape[2:]
+        outputs = F.interpolate(inputs, size=(int(H * self.param), int(W * self.param)), mode='area')
+        return F.interpolate(outputs, size=(H, W), mode='nearest')
+
+
+_JPEG_LUMA = [[16, 11, 10, 16, 24, 40, 51, 61], [12, 12, 14, 19, 26, 58, 60, 55],
+              [14, 13, 16, 24, 40, 57, 69, 56], [14, 17, 22, 29, 51, 87, 80, 62],
+              [18, 22, 37, 56, 68, 109, 103, 77], [24, 35, 55, 64, 81, 104, 113, 92],
+              [49, 64, 78, 87, 103, 121, 120, 101], [72, 92, 95, 98, 112, 100, 103, 99]]
+_JPEG_CHROMA = [[17, 18, 24, 47, 99, 99, 99, 99], [18, 21, 26, 66, 99, 99, 99, 99],
+                [24, 26, 56, 99, 99, 99, 99, 99], [47, 66, 99, 99, 99, 99, 99, 99]] + [[99] * 8] * 4
+
+
+class JPEGLayer(CorruptionLayer):
+    """JPEG-like compression: YCbCr with 4:2:0 chroma subsampling, 8x8 DCT and
+    quantization with the standard tables scaled to `quality`. Entropy coding is
+    lossless and therefore skipped."""
+    params = [80, 65, 58, 50, 40]  # quality
+
+    def __init__(self, severity=1):
+        super(JPEGLayer, self).__init__(severity)
+        quality = self.param
+        scale = 5000 / quality if quality < 50 else 200 - 2 * quality  # libjpeg quality scaling
+        tables = [torch.tensor(t, dtype=torch.float) for t in [_JPEG_LUMA, _JPEG_CHROMA, _JPEG_CHROMA]]
+        tables = [((t * scale + 50) / 100).floor().clamp(1, 255) for t in tables]
+        self.register_buffer('_qtable', torch.stack(tables).view(1, 3, 1, 1, 8, 8))
+
+        n = torch.arange(8, dtype=torch.float)
+        dct = torch.cos((2 * n.view(1, -1) + 1) * n.view(-1, 1) * math.pi / 16) * math.sqrt(2 / 8)
+        dct[0] = dct[0] / math.sqrt(2)
+        self.register_buffer('_dct', dct)  # orthonormal DCT-II
+
+        self.register_buffer('_rgb2ycbcr', torch.tensor([[0.299, 0.587, 0.114],
+                                                         [-0.168736, -0.331264, 0.5],
+                                                         [0.5, -0.418688, -0.081312]]))
+
+    def corrupt(self, inputs, generator):
+        N, _, H, W = inputs.shape
+        pad_h, pad_w = (-H) % 16, (-W) % 16
+        x = F.pad(inputs * 255, (0, pad_w, 0, pad_h), mode='replicate')
+
+        ycbcr = torch.einsum('ij,njhw->nihw', self._rgb2ycbcr, x)  # chroma centered at 0
+        y = ycbcr[:, :1]
+        cbcr = F.avg_pool2d(ycbcr[:, 1:], 2)  # 4:2:0
+
+        y = self._quantize(y - 128, self._qtable[:, :1]) + 128
+        cbcr = self._quantize(cbcr, self._qtable[:, 1:])
+        cbcr = F.interpolate(cbcr, scale_factor=2, mode='bilinear', **kwargs)  # libjpeg fancy upsampling
+
+        r = y + 1.402 * cbcr[:, 1:]
+        g = y - 0.344136 * cbcr[:, :1] - 0.714136 * cbcr[:, 1:]
+        b = y + 1.772 * cbcr[:, :1]
+        outputs = torch.cat([r, g, b], dim=1)[:, :, :H, :W]
+        return outputs.round() / 255
+
+    def _quantize(self, x, qtable):
+        N, C, H, W = x.shape
+        blocks = x.view(N, C, H // 8, 8, W // 8, 8).permute(0, 1, 2, 4, 3, 5)  # (N, C, H/8, W/8, 8, 8)
+        coef = self._dct @ blocks @ self._dct.t()
+        coef = (coef / qtable).round() * qtable
+        blocks = self._dct.t() @ coef @ self._dct
+        return blocks.permute(0, 1, 2, 4, 3, 5).reshape(N, C, H, W)
+
+
+CORRUPTION_LAYERS = {
+    'gaussian_noise': GaussianNoiseLayer,
+    'shot_noise': ShotNoiseLayer,
+    'impulse_noise': ImpulseNoiseLayer,
+    'speckle_noise': SpeckleNoiseLayer,
+    'gaussian_blur': GaussianBlurLayer,
+    'defocus_blur': DefocusBlurLayer,
+    'zoom_blur': ZoomBlurLayer,
+    'contrast': ContrastLayer,
+    'brightness': BrightnessLayer,
+    'saturate': SaturateLayer,
+    'pixelate': PixelateLayer,
+    'jpeg_compression': JPEGLayer,
+}
+
+
+def get_corruption_layer(name, severity):
+    if name not in CORRUPTION_LAYERS:
+        raise NotImplementedError()
+    return CORRUPTION_LAYERS[name](severity=severity)
+
+
+class CorruptedLoader(object):
+    """Wrap a DataLoader so that every batch is corrupted on `device` right after loading.
+
+    The corruption is seeded at the start of every pass, so repeated passes (and the
+    feature cache) see the same corrupted images. The random draws are made per batch:
+    the noise of a sample depends on the batch size, which the feature cache records.
+    With `classes`, only the samples of those labels are corrupted (e.g. the in-distribution
+    class of a full one-class test set); the others are passed through clean.
+    """
+
+    def __init__(self, loader, corruption, device, seed=0, classes=None):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.corruption = corruption.to(device)
+        self.device = device
+        self.seed = seed
+        self.classes = None if classes is None else sorted(classes if isinstance(classes, list) else [classes])
+
+    def __iter__(self):
+        generator = torch.Generator(device=self.device).manual_seed(self.seed)
+        for x, y in self.loader:
+            if not torch.is_tensor(x):
+                raise ValueError(f'{type(self.dataset).__name__} yields {type(x).__name__} batches; '
+                                 f'only single image tensor batches can be corrupted')
+            with torch.no_grad():
+                x = x.to(self.device)
+                x_c = self.corruption(x, generator=generator)
+                if self.classes is not None:
+                    mask = torch.isin(torch.as_tensor(y), torch.tensor(self.classes)).to(self.device)
+                    x_c = torch.where(mask[:, None, None, None], x_c, x)
+            yield x_c, y
+
+    def __len__(self):
+        return len(self.loader)
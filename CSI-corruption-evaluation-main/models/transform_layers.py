@@ -66,6 +66,82 @@ def hsv2rgb(hsv):
     return v - c * t
 
 
+def _rand(generator=None):
+    """One host-side uniform draw; from the global NumPy RNG unless a torch.Generator is given."""
+    if generator is None:
+        return np.random.rand()
+    return torch.rand(1, generator=generator, device=generator.device).item()
+
+
+def _randint(high, generator=None):
+    if generator is None:
+        return np.random.randint(high)
+    return int(torch.randint(high, (1,), generator=generator, device=generator.device).item())
+
+
+_GAMMA = -0x61c8864680b583eb  # 0x9e3779b97f4a7c15 as a signed int64
+
+
+def _mix64(z):
+    """SplitMix64 finalizer on an int64 tensor (wrapping arithmetic)."""
+    z = (z ^ ((z >> 30) & 0x3ffffffff)) * -0x40a7b892e31b1a47  # 0xbf58476d1ce4e5b9
+    z = (z ^ ((z >> 27) & 0x1fffffffff)) * -0x6b2fb644ecceee15  # 0x94d049bb133111eb
+    return z ^ ((z >> 31) & 0x1ffffffff)
+
+
+class RowGenerator(object):
+    """Random source whose draws for row i depend only on the keys of row i.
+
+    Each key is an int or an int64 tensor (N); the keys of a row (e.g. dataset index and
+    view) seed a SplitMix64 stream, so the draws of a sample do not depend on which batch,
+    batch size or position it comes in. The eval augmentations (HorizontalFlipLayer,
+    ColorJitterLayer, RandomColorGrayLayer, RandomResizedCropLayer and
+    FusedSimCLRAugmentation) accept it in place of a torch.Generator.
+    """
+
+    def __init__(self, *keys):
+        seeds = torch.zeros((), dtype=torch.long)
+        for key in keys:
+            seeds = _mix64(seeds + _GAMMA + torch.as_tensor(key, dtype=torch.long))
+        self.seeds = seeds.view(-1)
+        self.device = self.seeds.device
+        self.counter = 0
+
+    def __len__(self):
+        return self.seeds.size(0)
+
+    def rand(self, n, dtype=torch.float):
+        """(N, n) uniform draws in [0, 1); every call continues the stream of each row."""
+        steps = torch.arange(self.counter + 1, self.counter + n + 1, device=self.device) * _GAMMA
+        self.counter += n
+        bits = _mix64(self.seeds.view(-1, 1) + steps) >> 11 & ((1 << 53) - 1)  # 53 random bits
+        return (bits.double() * 2. ** -53).to(dtype)
+
+
+def _uniform_(tensor, low, high, generator=None):
+    """tensor.uniform_(low, high), with one row of draws per sample from a RowGenerator."""
+    if isinstance(generator, RowGenerator):
+        u = generator.rand(tensor[0].numel(), tensor.dtype).to(tensor.device).view(tensor.shape)
+        return tensor.copy_(low + (high - low) * u)
+    return tensor.uniform_(low, high, generator=generator)
+
+
+def _bernoulli(prob, generator=None):
+    """torch.bernoulli(prob) of a (N) probability tensor, per sample for a RowGenerator."""
+    if isinstance(generator, RowGenerator):
+        return (generator.rand(1, prob.dtype).to(prob.device).view(prob.shape) < prob).to(prob.dtype)
+    return torch.bernoulli(prob, generator=generator)
+
+
+class AugmentationSequential(nn.Sequential):
+    """nn.Sequential of augmentation layers that forwards the same torch.Generator to each layer."""
+
+    def forward(self, inputs, generator=None):
+        for module in self:
+            inputs = module(inputs, generator=generator)
+        return inputs
+
+
 class RandomResizedCropLayer(nn.Module):
     def __init__(self, size=None, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
         '''
@@ -82,13 +158,13 @@ class RandomResizedCropLayer(nn.Module):
         self.scale = scale
         self.ratio = ratio
 
-    def forward(self, inputs, whbias=None):
+    def forward(self, inputs, whbias=None, generator=None):
         _device = inputs.device
         N = inputs.size(0)
         _theta = self._eye.repeat(N, 1, 1)
 
         if whbias is None:
-            whbias = self._sample_latent(inputs)
+            whbias = self._sample_latent(inputs, generator=generator)
 
         _theta[:, 0, 0] = whbias[:, 0]
         _theta[:, 1, 1] = whbias[:, 1]
@@ -130,38 +206,46 @@ class RandomResizedCropLayer(nn.Module):
 
         return whbias
 
-    def _sample_latent(self, inputs):
-
+    def _sample_latent(self, inputs, generator=None, n_trials=10):
+        """
+        Sample (w, h, w_bias, h_bias) of every image on the input's device and dtype.
+        Each image gets n_trials (area, ratio) candidates and keeps the first one that
+        fits; if none does, it falls back to the full image (central crop).
+        generator : torch.Generator on the input device, or a RowGenerator
+        """
         _device = inputs.device
-        N, _, width, height = inputs.shape
+        _dtype = inputs.dtype
+        N, _, height, width = inputs.shape  # w, w_bias: along the last (x) axis, as _theta[:, 0]
+
+        if isinstance(generator, RowGenerator):
+            u = generator.rand(2 * n_trials + 2, _dtype).to(_device)
+        else:
+            u = torch.rand(N, 2 * n_trials + 2, generator=generator, device=_device, dtype=_dtype)
+        u_area, u_ratio, u_bias = u[:, :n_trials], u[:, n_trials:2 * n_trials], u[:, 2 * n_trials:]
 
-        # N * 10 trial
         area = width * height
-        target_area = np.random.uniform(*self.scale, N * 10) * area
+        target_area = (self.scale[0] + (self.scale[1] - self.scale[0]) * u_area) * area
         log_ratio = (math.log(self.ratio[0]), math.log(self.ratio[1]))
-        aspect_ratio = np.exp(np.random.uniform(*log_ratio, N * 10))
+        aspect_ratio = torch.exp(log_ratio[0] + (log_ratio[1] - log_ratio[0]) * u_ratio)
 
         # If doesn't satisfy ratio condition, then do central crop
-        w = np.round(np.sqrt(target_area * aspect_ratio))
-        h = np.round(np.sqrt(target_area / aspect_ratio))
-        cond = (0 < w) * (w <= width) * (0 < h) * (h <= height)
-        w = w[cond]
-        h = h[cond]
-        cond_len = w.shape[0]
-        if cond_len >= N:
-            w = w[:N]
-            h = h[:N]
-        else:
-            w = np.concatenate([w, np.ones(N - cond_len) * width])
-            h = np.concatenate([h, np.ones(N - cond_len) * height])
-
-        w_bias = np.random.randint(w - width, width - w + 1) / width
-        h_bias = np.random.randint(h - height, height - h + 1) / height
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        cond = (0 < w) & (w <= width) & (0 < h) & (h <= height)  # (N, n_trials)
+        first = cond.long().argmax(dim=1, keepdim=True)  # first valid trial
+        found = cond.any(dim=1)
+        w = torch.where(found, w.gather(1, first).squeeze(1), w.new_full((N,), width))
+        h = torch.where(found, h.gather(1, first).squeeze(1), h.new_full((N,), height))
+
+        # integer bias uniform in [w - width, width - w]
+        w_bias = torch.floor(u_bias[:, 0] * (2 * (width - w) + 1)).clamp(max=2 * (width - w)) + w - width
+        h_bias = torch.floor(u_bias[:, 1] * (2 * (height - h) + 1)).clamp(max=2 * (height - h)) + h - height
+        w_bias = w_bias / width
+        h_bias = h_bias / height
         w = w / width
         h = h / height
 
-        whbias = np.column_stack([w, h, w_bias, h_bias])
-        whbias = torch.tensor(whbias, device=_device)
+        whbias = torch.stack([w, h, w_bias, h_bias], dim=1)
 
         return whbias
 
@@ -205,18 +289,18 @@ class Rotation(nn.Module):
         self.max_range = max_range
         self.prob = 0.5
 
-    def forward(self, input, aug_index=None):
+    def forward(self, input, aug_index=None, generator=None):
         _device = input.device
 
         _, _, H, W = input.size()
 
         if aug_index is None:
-            aug_index = np.random.randint(4)
+            aug_index = _randint(4, generator)
 
             output = torch.rot90(input, aug_index, (2, 3))
 
             _prob = input.new_full((input.size(0),), self.prob)
-            _mask = torch.bernoulli(_prob).view(-1, 1, 1, 1)
+            _mask = torch.bernoulli(_prob, generator=generator).view(-1, 1, 1, 1)
             output = _mask * input + (1-_mask) * output
 
         else:
@@ -232,18 +316,18 @@ class CutPerm(nn.Module):
         self.max_range = max_range
         self.prob = 0.5
 
-    def forward(self, input, aug_index=None):
+    def forward(self, input, aug_index=None, generator=None):
         _device = input.device
 
         _, _, H, W = input.size()
 
         if aug_index is None:
-            aug_index = np.random.randint(4)
+            aug_index = _randint(4, generator)
 
             output = self._cutperm(input, aug_index)
 
             _prob = input.new_full((input.size(0),), self.prob)
-            _mask = torch.bernoulli(_prob).view(-1, 1, 1, 1)
+            _mask = torch.bernoulli(_prob, generator=generator).view(-1, 1, 1, 1)
             output = _mask * input + (1 - _mask) * output
 
         else:
@@ -272,27 +356,23 @@ class CutPerm(nn.Module):
 class HorizontalFlipLayer(nn.Module):
     def __init__(self):
         """
-        img_size : (int, int, int)
-            Height and width must be powers of 2.  E.g. (32, 32, 1) or
-            (64, 128, 3). Last number indicates number of channels, e.g. 1 for
-            grayscale or 3 for RGB
+        Flip each image of the batch horizontally with probability 0.5.
+        Flipped images are exact mirrors (index flip, no interpolation).
         """
         super(HorizontalFlipLayer, self).__init__()
-        # torch.eye(2, 3): diagna matrix
-        #    tensor([[1., 0., 0.],
-        #         [0., 1., 0.]])
-        _eye = torch.eye(2, 3)
-        self.register_buffer('_eye', _eye)
 
-    def forward(self, inputs):
+    def forward(self, inputs, mask=None, generator=None):
+        """
+        mask : bool tensor (N) of the images to flip. When None, it is drawn with
+            torch.bernoulli as before (flip where the draw is 0), so the random
+            stream is consumed exactly like the previous affine_grid version.
+        generator : torch.Generator on the input device (or a RowGenerator) used to draw the mask
+        """
         _device = inputs.device
         N = inputs.size(0)
-        _theta = self._eye.repeat(N, 1, 1)
-        r_sign = torch.bernoulli(torch.ones(N, device=_device) * 0.5) * 2 - 1
-        _theta[:, 0, 0] = r_sign
-        grid = F.affine_grid(_theta, inputs.size(), **kwargs).to(_device)
-        inputs = F.grid_sample(inputs, grid, padding_mode='reflection', **kwargs)
-        return inputs
+        if mask is None:
+            mask = _bernoulli(torch.ones(N, device=_device) * 0.5, generator) == 0
+        return torch.where(mask.view(N, 1, 1, 1), inputs.flip(3), inputs)
 
 
 class RandomColorGrayLayer(nn.Module):
@@ -303,7 +383,7 @@ class RandomColorGrayLayer(nn.Module):
         _weight = torch.tensor([[0.299, 0.587, 0.114]])
         self.register_buffer('_weight', _weight.view(1, 3, 1, 1))
 
-    def forward(self, inputs, aug_index=None):
+    def forward(self, inputs, aug_index=None, generator=None):
 
         if aug_index == 0:
             return inputs
@@ -313,7 +393,7 @@ class RandomColorGrayLayer(nn.Module):
 
         if aug_index is None:
             _prob = inputs.new_full((inputs.size(0),), self.prob)
-            _mask = torch.bernoulli(_prob).view(-1, 1, 1, 1)
+            _mask = _bernoulli(_prob, generator).view(-1, 1, 1, 1)
 
             gray = inputs * (1 - _mask) + gray * _mask
 
@@ -349,43 +429,139 @@ class ColorJitterLayer(nn.Module):
             value = None
         return value
 
-    def adjust_contrast(self, x):
+    def adjust_contrast(self, x, generator=None):
         if self.contrast:
-            factor = x.new_empty(x.size(0), 1, 1, 1).uniform_(*self.contrast)
+            factor = _uniform_(x.new_empty(x.size(0), 1, 1, 1), *self.contrast, generator)
             means = torch.mean(x, dim=[2, 3], keepdim=True)
             x = (x - means) * factor + means
         return torch.clamp(x, 0, 1)
 
-    def adjust_hsv(self, x):
+    def sample_hsv(self, x, generator=None):
         f_h = x.new_zeros(x.size(0), 1, 1)
         f_s = x.new_ones(x.size(0), 1, 1)
         f_v = x.new_ones(x.size(0), 1, 1)
 
         if self.hue:
-            f_h.uniform_(*self.hue)
+            f_h = _uniform_(f_h, *self.hue, generator)
         if self.saturation:
-            f_s = f_s.uniform_(*self.saturation)
+            f_s = _uniform_(f_s, *self.saturation, generator)
         if self.brightness:
-            f_v = f_v.uniform_(*self.brightness)
+            f_v = _uniform_(f_v, *self.brightness, generator)
 
-        return RandomHSVFunction.apply(x, f_h, f_s, f_v)
+        return f_h, f_s, f_v
+
+    def adjust_hsv(self, x, generator=None):
+        return RandomHSVFunction.apply(x, *self.sample_hsv(x, generator))
+
+    def transform(self, inputs, generator=None):
+        if isinstance(generator, RowGenerator):  # the order is drawn per sample
+            N = inputs.size(0)
+            contrast_first = generator.rand(1, inputs.dtype)[:, 0].to(inputs.device) > 0.5
+            factor = None
+            if self.contrast:
+                factor = _uniform_(inputs.new_empty(N, 1, 1, 1), *self.contrast, generator)
+            hsv = self.sample_hsv(inputs, generator)
+            return _jitter_rows(inputs, torch.arange(N, device=inputs.device), contrast_first, factor, hsv)
 
-    def transform(self, inputs):
         # Shuffle transform
-        if np.random.rand() > 0.5:
+        if _rand(generator) > 0.5:
             transforms = [self.adjust_contrast, self.adjust_hsv]
         else:
             transforms = [self.adjust_hsv, self.adjust_contrast]
 
         for t in transforms:
-            inputs = t(inputs)
+            inputs = t(inputs, generator)
 
         return inputs
 
-    def forward(self, inputs):
+    def forward(self, inputs, generator=None):
         _prob = inputs.new_full((inputs.size(0),), self.prob)
-        _mask = torch.bernoulli(_prob).view(-1, 1, 1, 1)
-        return inputs * (1 - _mask) + self.transform(inputs) * _mask
+        _mask = _bernoulli(_prob, generator).view(-1, 1, 1, 1)
+        return inputs * (1 - _mask) + self.transform(inputs, generator) * _mask
+
+
+def _jitter_rows(inputs, idx, contrast_first, contrast, hsv):
+    """Contrast and HSV jitter of inputs[idx], in the order given per row by contrast_first (N).
+
+    contrast (N, 1, 1, 1) or None and hsv = (f_h, f_s, f_v) hold the factors of all N rows."""
+    outputs = inputs[idx]
+    for first in [True, False]:
+        sel = (contrast_first[idx] == first).nonzero(as_tuple=True)[0]
+        if sel.numel() == 0:
+            continue
+        rows = idx[sel]
+        x = inputs[rows]
+        for name in (['contrast', 'hsv'] if first else ['hsv', 'contrast']):
+            if name == 'contrast':
+                if contrast is not None:
+                    means = torch.mean(x, dim=[2, 3], keepdim=True)
+                    x = (x - means) * contrast[rows] + means
+                x = torch.clamp(x, 0, 1)
+            else:
+                f_h, f_s, f_v = hsv
+                x = RandomHSVFunction.apply(x, f_h[rows], f_s[rows], f_v[rows])
+        outputs[sel] = x
+    return outputs
+
+
+class FusedSimCLRAugmentation(nn.Module):
+    def __init__(self, color_jitter, color_gray, resize_crop=None):
+        """
+        ColorJitterLayer -> RandomColorGrayLayer -> (RandomResizedCropLayer) in one module.
+        The random numbers are drawn in the same order and shapes as the nn.Sequential of
+        the three layers, so the output distribution (and, for a fixed seed, the output) is
+        unchanged. Jitter and grayscale are computed only on the selected rows, and the crop
+        is a single grid_sample when the output size equals the input size.
+        """
+        super(FusedSimCLRAugmentation, self).__init__()
+        self.color_jitter = color_jitter
+        self.color_gray = color_gray
+        self.resize_crop = resize_crop
+
+    def forward(self, inputs, generator=None):
+        N = inputs.size(0)
+        outputs = inputs.clone()
+
+        # color jitter on the rows of _mask
+        jitter = self.color_jitter
+        _mask = _bernoulli(inputs.new_full((N,), jitter.prob), generator).bool()
+        if isinstance(generator, RowGenerator):  # the order is drawn per sample
+            contrast_first = generator.rand(1, inputs.dtype)[:, 0].to(inputs.device) > 0.5
+            order = ['contrast', 'hsv']
+        else:
+            contrast_first = torch.full((N,), _rand(generator) > 0.5, dtype=torch.bool, device=inputs.device)
+            order = ['contrast', 'hsv'] if contrast_first[0] else ['hsv', 'contrast']
+        factors = {'contrast': None}
+        for name in order:
+            if name == 'contrast' and jitter.contrast:
+                factors['contrast'] = _uniform_(inputs.new_empty(N, 1, 1, 1), *jitter.contrast, generator)
+            elif name == 'hsv':
+                factors['hsv'] = jitter.sample_hsv(inputs, generator)
+
+        idx = _mask.nonzero(as_tuple=True)[0]
+        if idx.numel() > 0:
+            outputs[idx] = _jitter_rows(inputs, idx, contrast_first, factors['contrast'], factors['hsv'])
+
+        # grayscale on the rows of _mask
+        _mask = _bernoulli(inputs.new_full((N,), self.color_gray.prob), generator).bool()
+        idx = _mask.nonzero(as_tuple=True)[0]
+        if idx.numel() > 0:
+            l = F.conv2d(outputs[idx], self.color_gray._weight)
+            outputs[idx] = l.expand(-1, 3, -1, -1)
+
+        if self.resize_crop is None:
+            return outputs
+
+        whbias = self.resize_crop._sample_latent(outputs, generator=generator)
+        size = self.resize_crop.size
+        if size is not None and tuple(size[:2]) != tuple(inputs.shape[2:]):
+            return self.resize_crop(outputs, whbias)  # resampling to another size keeps the area pooling
+
+        zeros = whbias.new_zeros(N)
+        _theta = torch.stack([whbias[:, 0], zeros, whbias[:, 2],
+                              zeros, whbias[:, 1], whbias[:, 3]], dim=1).view(N, 2, 3).to(inputs.dtype)
+        grid = F.affine_grid(_theta, outputs.size(), **kwargs)
+        return F.grid_sample(outputs, grid, padding_mode='reflection', **kwargs)
 
 
 class RandomHSVFunction(Function):
@@ -0,0 +1,176 @@
+"""Evaluate the one-class checkpoint of every class against a test set decoded once.
+
+The test set is tensorized once into shared memory; each checkpoint (one per
+--one_class_idx) is then scored on it with the single-pass one-class evaluation,
+either in turn or in --one_class_workers processes (spread over the visible GPUs, one
+device per process). The per-class rows and the mean table of eval.py are printed at
+the end.
+
+    python one_class_sweep.py --mode ood_pre --dataset cifar10 --model resnet18 --ood_score CSI \
+        --shift_trans_type rotation --ood_samples 10 --resize_factor 0.54 --resize_fix \
+        --one_class_checkpoints <CHECKPOINT_DIR or MANIFEST.json>
+"""
+import os
+import re
+import json
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+
+from common.common import parse_args
+import models.classifier as C
+from models.corruption_layers import get_corruption_layer, CorruptedLoader
+from datasets import get_dataset, get_superclass_list, get_subclass_dataset
+from datasets.datasets import get_dataset_labels
+from evals.feature_cache import get_dataset_fingerprint
+from evals.ood_pre import eval_one_class_detection
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_checkpoints(path):
+    """{class index: checkpoint path} from a json manifest or a directory of checkpoints."""
+    if os.path.isfile(path):
+        with open(path) as f:
+            return {int(c): ckpt for c, ckpt in json.load(f).items()}
+
+    checkpoints = dict()
+    for name in sorted(os.listdir(path)):
+        match = re.search(r'(\d+)\D*$', name)  # e.g. cifar10_oc_class3.model -> 3
+        if match is None:
+            continue
+        assert int(match.group(1)) not in checkpoints, f'two checkpoints of class {match.group(1)} in {path}'
+        checkpoints[int(match.group(1))] = os.path.join(path, name)
+    return checkpoints
+
+
+def tensorize(dataset, batch_size):
+    """Decode `dataset` once into shared-memory (N, C, H, W) images and (N) labels."""
+    loader = DataLoader(dataset, shuffle=False, batch_size=batch_size, num_workers=4)
+    x_all = None
+    offset = 0
+    for x, y in loader:
+        assert torch.is_tensor(x), 'only datasets of single image tensors can be tensorized'
+        if x_all is None:
+            x_all = torch.empty((len(dataset),) + x.shape[1:], dtype=x.dtype).share_memory_()
+            y_all = torch.empty(len(dataset), dtype=torch.long).share_memory_()
+        x_all[offset:offset + len(x)] = x
+        y_all[offset:offset + len(x)] = torch.as_tensor(y)
+        offset += len(x)
+    assert offset == len(dataset)
+    return x_all, y_all
+
+
+_worker = dict()
+
+
+def init_worker(P, train_set, x_test, y_test, fingerprint, n_threads=None, counter=None):
+    num_workers = 4
+    if n_threads is not None:  # pool process: daemonic, so its DataLoaders cannot fork workers
+        torch.set_num_threads(n_threads)
+        num_workers = 0
+    if counter is not None and torch.cuda.is_available():  # pin each pool process to its own GPU
+        with counter.get_lock():
+            rank = counter.value
+            counter.value += 1
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    test_set = TensorDataset(x_test, y_test)
+    _worker.update({'P': P, 'train_set': train_set, 'test_set': test_set, 'num_workers': num_workers,
+                    'fingerprint': fingerprint})
+
+
+def eval_class(one_class_idx, load_path):
+    """Score the checkpoint of class `one_class_idx` on the shared test set."""
+    P, train_set, test_set = _worker['P'], _worker['train_set'], _worker['test_set']
+    P.one_class_idx = one_class_idx
+    start = time.time()
+
+    kwargs = {'pin_memory': False, 'num_workers': _worker['num_workers']}
+    cls_list = get_superclass_list(P.dataset)
+    train_subset = get_subclass_dataset(train_set, classes=cls_list[one_class_idx])
+    train_loader = DataLoader(train_subset, shuffle=True, batch_size=P.batch_size, **kwargs)
+    test_loader = DataLoader(test_set, shuffle=False, batch_size=P.test_batch_size, num_workers=0)
+    if P.corruption is not None:
+        id_classes = None if P.corrupt_ood else cls_list[one_class_idx]  # the other classes are the OOD sets
+        test_loader = CorruptedLoader(test_loader, get_corruption_layer(P.corruption, P.corruption_severity), device,
+                                      classes=id_classes)
+
+    simclr_aug = C.get_simclr_augmentation(P, image_size=P.image_size).to(device)
+    P.shift_trans, P.K_shift = C.get_shift_module(P, eval=True)
+    P.shift_trans = P.shift_trans.to(device)
+
+    model = C.get_classifier(P.model, n_classes=P.n_classes).to(device)
+    model = C.get_shift_classifer(model, P.K_shift).to(device)
+    print("Load wieth", load_path)
+    checkpoint = torch.load(load_path, map_location=torch.device('cpu'))
+    model.load_state_dict(checkpoint, strict=not P.no_strict)
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad = True
+
+    auroc_dict = eval_one_class_detection(P, model, test_loader, test_set.tensors[1].numpy(), cls_list, P.ood_score,
+                                          train_loader=train_loader, simclr_aug=simclr_aug,
+                                          fingerprint=_worker['fingerprint'])
+    print(f'[class {one_class_idx}] {time.time() - start:.2f}s')
+    return one_class_idx, auroc_dict, P.one_class_real_mean
+
+
+def main():
+    P = parse_args()
+    assert P.mode == 'ood_pre' and P.one_class_checkpoints is not None
+    assert not (P.in_attack or P.out_attack)  # single-pass one-class evaluation
+    P.ood_score = P.ood_score[:1]  # as eval_ood_detection
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(P.local_rank)
+
+    checkpoints = get_checkpoints(P.one_class_checkpoints)
+    print(f'{len(checkpoints)} checkpoints: ' + ' '.join(map(str, sorted(checkpoints.keys()))))
+
+    ### Initialize dataset and the shared test set once ###
+    startup = time.time()
+    train_set, test_set, image_size, n_classes = get_dataset(P, dataset=P.dataset, eval=True)
+    P.image_size = image_size
+    P.n_classes = n_classes
+    P.n_superclasses = len(get_superclass_list(P.dataset))
+    assert get_dataset_labels(train_set) is not None  # per-class train subsets without decoding
+
+    fingerprint = get_dataset_fingerprint(test_set)  # feature cache key of the decoded set
+    x_test, y_test = tensorize(test_set, P.test_batch_size)
+    print(f'Test set {tuple(x_test.shape)} decoded in {time.time() - startup:.2f}s')
+
+    ### Evaluate every checkpoint ###
+    jobs = sorted(checkpoints.items())
+    if P.one_class_workers > 1:
+        n_threads = max(torch.get_num_threads() // P.one_class_workers, 1)
+        if torch.cuda.is_available() and P.one_class_workers > torch.cuda.device_count():
+            print(f'{P.one_class_workers} workers share {torch.cuda.device_count()} GPU(s)')
+        ctx = mp.get_context('spawn')
+        counter = ctx.Value('i', 0)
+        with ctx.Pool(P.one_class_workers, initializer=init_worker,
+                      initargs=(P, train_set, x_test, y_test, fingerprint, n_threads, counter)) as pool:
+            results = pool.starmap(eval_class, jobs)
+    else:
+        init_worker(P, train_set, x_test, y_test, fingerprint)
+        results = [eval_class(c, path) for c, path in jobs]
+
+    ### AUROC table (one row per checkpoint, as printed by eval.py) ###
+    oods = [f'one_class_{c}' for c in range(P.n_superclasses)]
+    ood_score = P.ood_score[0]
+    print(f'\nAUROC (score: {ood_score})')
+    print('\t'.join(['class'] + oods + ['one_class_mean', 'One_class_real_mean']))
+    means, real_means = [], []
+    for one_class_idx, auroc_dict, real_mean in results:
+        aurocs = [auroc_dict[ood][ood_score] if ood in auroc_dict else None for ood in oods]
+        means.append(np.mean([auroc for auroc in aurocs if auroc is not None]))
+        real_means.append(real_mean)
+        print('\t'.join([str(one_class_idx)] + ['-' if auroc is None else f'{auroc:.4f}' for auroc in aurocs] +
+                        [f'{means[-1]:.4f}', f'{real_mean:.4f}']))
+    print('\t'.join(['mean'] + [''] * len(oods) + [f'{np.mean(means):.4f}', f'{np.mean(real_means):.4f}']))
+
+
+if __name__ == '__main__':
+    main()
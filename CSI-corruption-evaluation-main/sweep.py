@@ -0,0 +1,129 @@
+"""Evaluate one checkpoint on every CIFAR-C corruption x severity in a single process.
+
+The model, the train features and the train statistics (P.axis, CSI weights) are
+computed once; every corruption/severity test set is then scored against them.
+
+    python sweep.py --mode ood_pre --dataset cifar10-corruption --ood_score CSI --one_class_idx 0 \
+        --load_path <MODEL_PATH> --cifar_corruption_data ./CIFAR-10-C/defocus_blur.npy \
+        --cifar_corruption_types all --cifar_corruption_severity 1 2 3 4 5
+"""
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from common.common import parse_args
+import models.classifier as C
+from datasets import get_dataset, get_superclass_list, get_subclass_dataset
+from datasets.datasets import CIFAR_CORRUCPION, CIFAR_CORRUPTIONS, get_cifar_corruption_train_set
+from evals.ood_pre import prepare_ood_detection, set_ood_score, get_test_features, score_test_features
+
+P = parse_args()
+assert P.mode == 'ood_pre'
+assert P.dataset in ['cifar10-corruption', 'cifar100-corruption']
+
+### Set torch device ###
+P.n_gpus = torch.cuda.device_count()
+assert P.n_gpus <= 1  # no multi GPU
+P.multi_gpu = False
+
+if torch.cuda.is_available():
+    torch.cuda.set_device(P.local_rank)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+if P.cifar_corruption_types is None or P.cifar_corruption_types == ['all']:
+    corruptions = CIFAR_CORRUPTIONS
+else:
+    corruptions = P.cifar_corruption_types
+severities = sorted(P.cifar_corruption_severity)
+data_dir = os.path.dirname(P.cifar_corruption_data)
+label_path = 'CIFAR-100-C/labels.npy' if P.dataset == 'cifar100-corruption' else 'CIFAR-10-C/labels.npy'
+
+### Initialize train set and model once ###
+# only the train set: the test sets are built per corruption/severity below
+train_set = get_cifar_corruption_train_set(P.dataset)
+P.image_size = (P.image_size, P.image_size, 3)  # as get_dataset
+P.n_classes = 10 if P.dataset == 'cifar10-corruption' else 100
+
+if P.one_class_idx is not None:
+    cls_list = get_superclass_list(P.dataset)
+    P.n_superclasses = len(cls_list)
+    train_set = get_subclass_dataset(train_set, classes=cls_list[P.one_class_idx])
+
+kwargs = {'pin_memory': False, 'num_workers': 4}
+print("train_set", len(train_set))
+train_loader = DataLoader(train_set, shuffle=True, batch_size=P.batch_size, **kwargs)
+
+# OOD sets that do not depend on the corruption are loaded once as well
+ood_test_loader = dict()
+if P.one_class_idx is None:
+    assert P.ood_dataset is not None
+    for ood in P.ood_dataset:
+        ood_test_set = get_dataset(P, dataset=ood, test_only=True, image_size=P.image_size, eval=True, download=True)
+        ood_test_loader[ood] = DataLoader(ood_test_set, shuffle=False, batch_size=P.test_batch_size, **kwargs)
+
+simclr_aug = C.get_simclr_augmentation(P, image_size=P.image_size).to(device)
+P.shift_trans, P.K_shift = C.get_shift_module(P, eval=True)
+P.shift_trans = P.shift_trans.to(device)
+
+model = C.get_classifier(P.model, n_classes=P.n_classes).to(device)
+model = C.get_shift_classifer(model, P.K_shift).to(device)
+
+if P.load_path is not None:
+    print("Load wieth", P.load_path)
+    checkpoint = torch.load(P.load_path, map_location=torch.device('cpu'))
+    model.load_state_dict(checkpoint, strict=not P.no_strict)
+
+model.eval()
+for param in model.parameters():
+    param.requires_grad = True
+
+start = time.time()
+prepare_ood_detection(P, model, train_loader, simclr_aug=simclr_aug)
+print(f'Train statistics time: {time.time() - start:.2f}s')
+
+### Stream every corruption/severity test set through the shared statistics ###
+# table[ood_score][corruption][severity]: AUROC averaged over the OOD sets
+table = {ood_score: {corruption: dict() for corruption in corruptions} for ood_score in P.ood_score}
+for corruption in corruptions:
+    for severity in severities:
+        start = time.time()
+        test_set = CIFAR_CORRUCPION(cifar_corruption_label=label_path,
+                                    cifar_corruption_data=os.path.join(data_dir, f'{corruption}.npy'),
+                                    severity=severity)
+
+        if P.one_class_idx is not None:
+            id_set = get_subclass_dataset(test_set, classes=cls_list[P.one_class_idx])
+            ood_loaders = dict()
+            for ood in range(P.n_superclasses):
+                if ood == P.one_class_idx:
+                    continue
+                ood_set = get_subclass_dataset(test_set, classes=cls_list[ood])
+                ood_loaders[f'one_class_{ood}'] = DataLoader(ood_set, shuffle=False,
+                                                             batch_size=P.test_batch_size, **kwargs)
+        else:
+            id_set = test_set
+            ood_loaders = ood_test_loader
+        id_loader = DataLoader(id_set, shuffle=False, batch_size=P.test_batch_size, **kwargs)
+
+        feats = None
+        for ood_score in P.ood_score:
+            set_ood_score(P, model, ood_score, simclr_aug=simclr_aug)
+            if feats is None or P.in_attack or P.out_attack:  # attacks depend on the score
+                feats = get_test_features(P, model, id_loader, ood_loaders, simclr_aug=simclr_aug)
+            auroc_dict = score_test_features(P, feats[0], feats[1], ood_score)
+            auroc = np.mean([auroc_dict[ood][ood_score] for ood in auroc_dict.keys()])
+            table[ood_score][corruption][severity] = auroc
+            print(f'[{corruption} severity {severity} {ood_score}] AUROC {auroc:.4f} ({time.time() - start:.2f}s)')
+
+### AUROC table ###
+for ood_score in P.ood_score:
+    print(f'\nAUROC (score: {ood_score})')
+    print('\t'.join(['corruption'] + [f'severity_{s}' for s in severities] + ['mean']))
+    for corruption in corruptions:
+        aurocs = [table[ood_score][corruption][s] for s in severities]
+        print('\t'.join([corruption] + list(map('{:.4f}'.format, aurocs + [np.mean(aurocs)]))))
+    means = [np.mean([table[ood_score][c][s] for c in corruptions]) for s in severities]
+    print('\t'.join(['mean'] + list(map('{:.4f}'.format, means + [np.mean(means)]))))
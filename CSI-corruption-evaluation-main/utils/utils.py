@@ -1,4 +1,5 @@
 import os
+import hashlib
 import pickle
 import random
 import shutil
@@ -173,6 +174,14 @@ def set_random_seed(seed):
     torch.cuda.manual_seed(seed)
 
 
+def get_generator(device, *keys):
+    """torch.Generator on `device` whose stream is fixed by the integer `keys`
+    (e.g. sample offset and view), without touching the global RNGs."""
+    digest = hashlib.sha1(repr(tuple(int(k) for k in keys)).encode()).digest()
+    seed = int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+    return torch.Generator(device=device).manual_seed(seed)
+
+
 def normalize(x, dim=1, eps=1e-8):
     return x / (x.norm(dim=dim, keepdim=True) + eps)
 